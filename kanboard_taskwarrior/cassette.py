@@ -0,0 +1,198 @@
+# contains a record/replay harness for the kanboard JSON-RPC and taskwarrior command traffic
+# In record mode every kanboard call and taskwarrior command is captured (with its timing) into a compact cassette file (gzipped json lines),
+# in replay mode the captured responses are fed back deterministically (optionally with injected latency), so that
+# the sync can be run and profiled offline against traces of real boards
+
+import re
+import gzip
+import json
+import time
+import logging
+from collections import defaultdict,deque
+from kanboard import ClientError
+from tasklib import TaskWarrior
+from tasklib.backends import TaskWarriorException
+
+#taskwarrior commands which are used to name (and count) the recorded commands
+twCommands=("export","add","modify","start","stop","done","delete","annotate","config","show","--version")
+
+#parameters which hold times or dates (these change from run to run)
+timeKeys=("date","time","modified","due")
+timePattern=re.compile(r"\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?(\.\d+)?)?|\d{8}T\d{6}Z")
+
+def timeless(value,key=""):
+    """Replace the times and dates in call parameters, so calls which only differ in these can be matched"""
+    if isinstance(value,dict):
+        return {ky:timeless(val,ky) for ky,val in value.items()}
+    if isinstance(value,(list,tuple)):
+        return [timeless(val) for val in value]
+    if any(word in key.lower() for word in timeKeys):
+        return "<time>"
+    if isinstance(value,str):
+        return timePattern.sub("<time>",value)
+    return value
+
+def twCommandName(args):
+    return next(iter([arg for arg in args if arg in twCommands]),args[0] if args else "")
+
+class CassetteMiss(Exception):
+    """Raised when a call is replayed which is not on the cassette"""
+    pass
+
+class Cassette:
+    """Holds recorded kanboard calls and taskwarrior commands"""
+    def __init__(self,path,mode="record",latency=0.0):
+        if mode not in ("record","replay"):
+            raise ValueError(f"Unknown cassette mode {mode}")
+        self.path=path
+        self.mode=mode
+        #latency (seconds) which is added to every replayed call
+        self.latency=latency
+        self.entries=[]
+        self.counts=defaultdict(lambda: defaultdict(int))
+        #unused entries indexed by their exact call and by their call without times and dates
+        self._queues=defaultdict(deque)
+        self._timeless=defaultdict(deque)
+        if mode == "replay":
+            self.load()
+
+    @staticmethod
+    def key(kind,name,params):
+        return json.dumps([kind,name,params],sort_keys=True,default=str)
+
+    def load(self):
+        with gzip.open(self.path,'rt') as fid:
+            for line in fid:
+                entry=json.loads(line)
+                self.entries.append(entry)
+                self._queues[self.key(entry['kind'],entry['name'],entry['params'])].append(entry)
+                self._timeless[self.key(entry['kind'],entry['name'],timeless(entry['params']))].append(entry)
+        logging.info(f"Loaded {len(self.entries)} recorded calls from {self.path}")
+
+    def save(self):
+        if self.mode != "record":
+            return
+        with gzip.open(self.path,'wt') as fid:
+            for entry in self.entries:
+                fid.write(json.dumps(entry,default=str)+"\n")
+        logging.info(f"Recorded {len(self.entries)} calls to {self.path}")
+
+    def record(self,kind,name,params,result=None,error=None,transport=False,elapsed=0.0):
+        self.counts[kind][name]+=1
+        self.entries.append({"kind":kind,"name":name,"params":params,"result":result,"error":error,"transport":transport,"elapsed":round(elapsed,4)})
+
+    @staticmethod
+    def _next(queue):
+        #used entries stay in the other index and are skipped here
+        while queue:
+            entry=queue.popleft()
+            if not entry.get('used'):
+                return entry
+        return None
+
+    def replay(self,kind,name,params):
+        """Returns the recorded entry of a call
+        Calls are matched on their parameters, falling back to the next recorded call of the same method
+        with parameters which only differ in times and dates (e.g. when a parameter contains the current time)"""
+        self.counts[kind][name]+=1
+        entry=self._next(self._queues[self.key(kind,name,params)])
+        if entry is None:
+            entry=self._next(self._timeless[self.key(kind,name,timeless(params))])
+            if entry is None:
+                raise CassetteMiss(f"Unrecorded {kind} call {name} with parameters {json.dumps(params,default=str)}")
+            logging.warning(f"No exact recording of {name} with parameters {json.dumps(params,default=str)}, replaying it with parameters {json.dumps(entry['params'],default=str)}")
+        entry['used']=True
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return entry
+
+    def ncalls(self,kind):
+        return sum(self.counts[kind].values())
+
+    def summary(self):
+        return {kind:dict(counts) for kind,counts in self.counts.items()}
+
+
+class RecordingKBClient:
+    """Wraps a kanboard client and records all calls on the cassette"""
+    def __init__(self,client,cassette):
+        self._client=client
+        self._cassette=cassette
+
+    def __getattr__(self,name):
+        method=getattr(self._client,name)
+        def function(**kwargs):
+            t0=time.monotonic()
+            try:
+                result=method(**kwargs)
+            except ClientError as exc:
+                self._cassette.record("kb",name,kwargs,error=str(exc),transport=exc.__cause__ is not None,elapsed=time.monotonic()-t0)
+                raise
+            self._cassette.record("kb",name,kwargs,result=result,elapsed=time.monotonic()-t0)
+            return result
+        return function
+
+class ReplayKBClient:
+    """Stands in for a kanboard client and answers calls from the cassette"""
+    def __init__(self,cassette):
+        self._cassette=cassette
+
+    def __getattr__(self,name):
+        def function(**kwargs):
+            try:
+                entry=self._cassette.replay("kb",name,kwargs)
+            except CassetteMiss as exc:
+                raise ClientError(str(exc))
+            if entry['error'] is not None:
+                if entry['transport']:
+                    #keep the distinction between transport and API errors (see transport.py)
+                    raise ClientError(entry['error']) from ConnectionError(entry['error'])
+                raise ClientError(entry['error'])
+            return entry['result']
+        return function
+
+
+class RecordingTaskWarrior(TaskWarrior):
+    """Taskwarrior backend which records all executed commands on the cassette"""
+    def __init__(self,cassette,**kwargs):
+        self._cassette=cassette
+        super().__init__(**kwargs)
+
+    def _get_version(self):
+        version=super()._get_version()
+        self._cassette.record("tw","--version",["--version"],result=version)
+        return version
+
+    def execute_command(self,args,config_override=None,allow_failure=True,return_all=False):
+        t0=time.monotonic()
+        try:
+            result=super().execute_command(args,config_override=config_override,allow_failure=allow_failure,return_all=return_all)
+        except TaskWarriorException as exc:
+            self._cassette.record("tw",twCommandName(args),args,error=str(exc),elapsed=time.monotonic()-t0)
+            raise
+        self._cassette.record("tw",twCommandName(args),args,result=result,elapsed=time.monotonic()-t0)
+        return result
+
+class ReplayTaskWarrior(TaskWarrior):
+    """Taskwarrior backend which answers commands from the cassette (no task binary is needed)"""
+    def __init__(self,cassette,**kwargs):
+        self._cassette=cassette
+        super().__init__(**kwargs)
+
+    def _get_version(self):
+        return self._cassette.replay("tw","--version",["--version"])['result']
+
+    def execute_command(self,args,config_override=None,allow_failure=True,return_all=False):
+        try:
+            entry=self._cassette.replay("tw",twCommandName(args),args)
+        except CassetteMiss as exc:
+            raise TaskWarriorException(str(exc))
+        if entry['error'] is not None:
+            raise TaskWarriorException(entry['error'])
+        result=entry['result']
+        if return_all and not isinstance(result[0],list):
+            #recorded without stderr and returncode
+            result=(result,[""],0)
+        elif not return_all and result and isinstance(result[0],list):
+            result=result[0]
+        return result
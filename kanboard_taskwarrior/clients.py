@@ -3,27 +3,83 @@
 
 import kanboard
 import requests
+import time
 import logging
 from tasklib import TaskWarrior,Task
 from tasklib.backends import TaskWarriorException
+from kanboard_taskwarrior.transport import getPolicy,PolicyClient,TransportPolicy
+from kanboard_taskwarrior.cassette import RecordingKBClient,ReplayKBClient,RecordingTaskWarrior,ReplayTaskWarrior
 
-def serverIsreachable(server="example.com",timeout=2):
+#a server which answered a call less than this number of seconds ago is not probed again
+probeInterval=60
+
+def serverIsreachable(server="example.com",timeout=2,policy=None):
+    """Probe a server (through its transport policy, so the probe is rate limited, counted and trips the circuit breaker)"""
+    if policy is None:
+        policy=getPolicy(server)
+    if policy.lastsuccess is not None and time.monotonic()-policy.lastsuccess < probeInterval:
+        return True
+    def probe():
+        try:
+            requests.head(server, timeout=timeout)
+        except requests.RequestException as exc:
+            raise kanboard.ClientError(f"Kanboard server {server} is not reachable") from exc
     try:
-        requests.head(server, timeout=timeout)
+        policy.execute("probe",probe)
         return True
-    except requests.ConnectionError:
+    except kanboard.ClientError:
         logging.warning(f"Kanboard server {server} is not reachable, skipping")
         return False
 
+#pool of kanboard clients, shared by all sync projects (and profiles) within one process
+_kbpool={}
+
+#cassette to record the traffic to/replay the traffic from (see cassette.py)
+_cassette=None
+
+def useCassette(cassette):
+    global _cassette
+    _cassette=cassette
+    _kbpool.clear()
+
+#timeout (seconds) of a single kanboard request
+requestTimeout=30
+
+#transport policies used while replaying (retries and the circuit breaker still apply, but without rate limit and backoff)
+_replaypolicies={}
+
 def kbClient(kbserver,user,apitoken):
-    if not serverIsreachable(kbserver):
+    #all calls to a server go through its (shared) transport policy
+    replay=_cassette is not None and _cassette.mode == "replay"
+    if replay:
+        #replayed timings should reflect the sync itself, not the rate limiter
+        policy=_replaypolicies.setdefault(kbserver,TransportPolicy(rate=1e9,maxrate=1e9,burst=1e9,backoff=0))
+    else:
+        policy=getPolicy(kbserver)
+    if not policy.available():
+        logging.warning(f"Kanboard server {kbserver} is considered down, skipping")
+        return None
+    if not replay and not serverIsreachable(kbserver,policy=policy):
         return None
-    return kanboard.Client(kbserver,user,apitoken)
+    key=(kbserver,user,apitoken)
+    if key not in _kbpool:
+        if replay:
+            client=ReplayKBClient(_cassette)
+        else:
+            client=kanboard.Client(kbserver,user,apitoken,timeout=requestTimeout)
+            if _cassette is not None:
+                client=RecordingKBClient(client,_cassette)
+        _kbpool[key]=PolicyClient(client,policy)
+    return _kbpool[key]
 
 
 TWDoesNotExist=Task.DoesNotExist
 KBClientError=kanboard.ClientError
 TWClientError=TaskWarriorException
 
-def twClient():
-    return TaskWarrior(create=False)
+def twClient(taskrc=None,datadir=None):
+    """Returns a taskwarrior instance (default one when taskrc and datadir are not provided)"""
+    if _cassette is not None:
+        backend=ReplayTaskWarrior if _cassette.mode == "replay" else RecordingTaskWarrior
+        return backend(_cassette,data_location=datadir,taskrc_location=taskrc,create=False)
+    return TaskWarrior(data_location=datadir,taskrc_location=taskrc,create=False)
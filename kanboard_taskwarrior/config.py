@@ -1,11 +1,18 @@
 # Author R. Rietbroek Aug 2022
 # contains functionality to setup a syncing connection
 import logging
+import os
+import json
 from kanboard_taskwarrior.taskmap import getVtags,colkey,catkey,swimkey
 from kanboard_taskwarrior.clients import kbClient,twClient,KBClientError
 import sys
 from copy import deepcopy
 from datetime import datetime
+try:
+    import tomllib
+except ImportError:
+    #python < 3.11
+    tomllib=None
 
 def getDefault(projconf,key,fallback=""):
     if key in projconf.keys():
@@ -26,10 +33,11 @@ def prompt(message,default=""):
     else:
         return default
 
-def configUDA(mapper):
+def configUDA(mapper,tw=None):
     tpy="string"
 
-    tw=twClient()
+    if tw is None:
+        tw=twClient()
     for udaky,udamap in mapper.items():
         if not udaky.startswith("uda"):
             continue
@@ -48,12 +56,7 @@ def configUDA(mapper):
 
         # if valky in tw.config:
             # udaval2=tw.config[valky]
-        if udaky == "uda.swimlane":
-            label="kbSwim"
-        elif udaky == "uda.kbcat":
-            label="kbCat"
-        else:
-            label="kb"
+        label=udaLabel(udaky)
 
         #set label, type and permissible values
         tw.execute_command(["config", typeky, tpy])
@@ -62,6 +65,65 @@ def configUDA(mapper):
         uniqueval=",".join(set(udaval))
         tw.execute_command(["config",valky,uniqueval])
 
+def udaLabel(udaky):
+    if udaky == "uda.swimlane":
+        return "kbSwim"
+    elif udaky == "uda.kbcat":
+        return "kbCat"
+    else:
+        return "kb"
+
+def writeTaskrc(taskrc,settings):
+    """Write taskwarrior configuration settings to a taskrc file in one pass (existing settings are replaced in place)"""
+    with open(taskrc,'r') as fid:
+        lines=fid.readlines()
+    pending=dict(settings)
+    for i,line in enumerate(lines):
+        ky=line.split("=",1)[0].strip()
+        if "=" in line and ky in pending:
+            lines[i]=f"{ky}={pending.pop(ky)}\n"
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1]+="\n"
+    lines.extend([f"{ky}={val}\n" for ky,val in pending.items()])
+    #replace atomically so taskwarrior never sees a half written file
+    tmpfile=taskrc+".kbsync"
+    with open(tmpfile,'w') as fid:
+        fid.writelines(lines)
+    os.replace(tmpfile,taskrc)
+
+def configUDAs(mappers,tw=None):
+    """Register the uda values of several mappings at once
+    All settings are written to the taskrc in a single pass instead of running task config for every setting"""
+    if tw is None:
+        tw=twClient()
+    udavals={}
+    for mapper in mappers:
+        for udaky,udamap in mapper.items():
+            if not udaky.startswith("uda") or not udamap:
+                continue
+            udavals.setdefault(udaky,set()).update(udamap.keys())
+
+    settings={}
+    for udaky,udaval in udavals.items():
+        valky=f"{udaky}.values"
+        if valky in tw.config:
+            udaval.update(tw.config[valky].split(","))
+        settings[f"{udaky}.type"]="string"
+        settings[f"{udaky}.label"]=udaLabel(udaky)
+        settings[valky]=",".join(sorted(udaval))
+
+    if not settings:
+        return
+    taskrc=tw.taskrc_location or os.path.expanduser(os.environ.get("TASKRC","~/.taskrc"))
+    if os.path.isfile(taskrc):
+        writeTaskrc(taskrc,settings)
+    else:
+        #no taskrc file to edit, let taskwarrior handle it
+        for ky,val in settings.items():
+            tw.execute_command(["config",ky,val])
+    #force a reread of the configuration
+    tw._config=None
+
 def configMap(values,existingMap,maptype):
 
     aliases=[]
@@ -95,6 +157,14 @@ def configMapOptions(values,existingMap,maptype,optionsPool):
     
     return {ky:{"kbid":el["id"],"name":el["title"]} for ky,el in zip(aliases,values)}
 
+def fixUrl(url):
+    """possibly fix url so it start with https and ends with /jsonrpc.php"""
+    if not url.endswith('/jsonrpc.php'):
+        url+="/jsonrpc.php"
+    if not url.startswith('http'):
+        url="https://"+url
+    return url
+
 def runConfig(project,projconf):
     config={"project":project}
     
@@ -116,11 +186,7 @@ def runConfig(project,projconf):
     for ky,val in keyprompts.items():
         config[ky]=prompt(val[0],getDefault(projconf,ky,val[1]))
     
-    #possibly fix url so it start with https and ends with /jsonrpc.php
-    if not config["url"].endswith('/jsonrpc.php'):
-        config["url"]+="/jsonrpc.php"
-    if not config["url"].startswith('http'):
-        config["url"]="https://"+config["url"]
+    config["url"]=fixUrl(config["url"])
     
     #also setup mapping of this project
     kbclnt=kbClient(config["url"],config["user"],config["apitoken"])
@@ -152,3 +218,117 @@ def runConfig(project,projconf):
     mapper[colkey]=configMapOptions(columns,projconf['mapping'][colkey],"Column",getVtags())
     config["mapping"]=mapper
     return config
+
+
+def loadDeclarative(path):
+    """Load a declarative description of project links from a json or toml file"""
+    path=os.path.expanduser(path)
+    if path.endswith(".toml"):
+        if tomllib is None:
+            logging.error("Reading toml files requires python 3.11 or newer, use json instead")
+            sys.exit(1)
+        with open(path,'rb') as fid:
+            return tomllib.load(fid)
+    with open(path,'r') as fid:
+        return json.load(fid)
+
+def declarativeMap(values,aliases,maptype,namekey="name"):
+    """Map aliases to kanboard items by name (all items under their own name when no aliases are given)
+    Returns the mapping and a list of problems"""
+    if aliases is None:
+        return {el[namekey]:{"kbid":el["id"],"name":el[namekey]} for el in values},[]
+    byname={el[namekey]:el for el in values}
+    mapping={}
+    problems=[]
+    for alias,name in aliases.items():
+        if name not in byname:
+            problems.append(f"Kanboard {maptype} {name} does not exist")
+            continue
+        mapping[alias]={"kbid":byname[name]["id"],"name":name}
+    return mapping,problems
+
+def declarativeColumns(columns,vtagmap):
+    """Map vtags to kanboard columns by title (the columns take the vtags in order when no mapping is given, as in the interactive default)
+    Returns the mapping (in column order) and a list of problems"""
+    vtags=list(getVtags().values())
+    if vtagmap is None:
+        return {vtag:{"kbid":el["id"],"name":el["title"]} for vtag,el in zip(vtags,columns)},[]
+    problems=[f"Unknown column tag {vtag} (choose from {','.join(vtags)})" for vtag in vtagmap if vtag not in vtags]
+    bytitle={el["title"]:el for el in columns}
+    problems.extend([f"Kanboard column {title} does not exist" for title in vtagmap.values() if title not in bytitle])
+    mapping={}
+    for el in columns:
+        for vtag,title in vtagmap.items():
+            if title == el["title"] and vtag in vtags:
+                mapping[vtag]={"kbid":el["id"],"name":title}
+    return mapping,problems
+
+def declarativeConfig(description):
+    """Resolve a declarative description of project links against the kanboard servers without prompting
+    Projects and users are looked up by name (as in the interactive configuration, so no admin rights are needed), each user once per server. The description looks like:
+    {"servers":{"work":{"url":"kanboard.example.com","user":"me","apitoken":"..."}},
+     "projects":{"ProjA":{"server":"work","assignee":"me","columns":{"WAITING":"Backlog","ACTIVE":"Work in progress","COMPLETED":"Done"},
+                          "swimlanes":{"default":"Default swimlane"},"categories":{"bug":"Bug"}}}}
+    Server settings may also be given directly in a project, omitted swimlanes/categories/columns are mapped as in the interactive defaults
+    Returns the configurations (as runConfig) and a list of problems (nothing is returned when there are problems)"""
+    servers=description.get("servers",{})
+    problems=[]
+    #group the projects per server (url,user,apitoken)
+    perserver={}
+    for project,projdescr in description.get("projects",{}).items():
+        server=dict(servers.get(projdescr["server"],{})) if "server" in projdescr else {}
+        if "server" in projdescr and projdescr["server"] not in servers:
+            problems.append(f"{project}: unknown server {projdescr['server']}")
+            continue
+        server.update({ky:projdescr[ky] for ky in ("url","user","apitoken") if ky in projdescr})
+        missing=[ky for ky in ("url","user","apitoken") if not server.get(ky)]
+        if missing:
+            problems.append(f"{project}: missing {','.join(missing)}")
+            continue
+        perserver.setdefault((fixUrl(server["url"]),server["user"],server["apitoken"]),[]).append((project,projdescr))
+
+    configs=[]
+    for (url,user,apitoken),projects in perserver.items():
+        kbclnt=kbClient(url,user,apitoken)
+        if kbclnt is None:
+            problems.append(f"Cannot reach kanboard instance {url} as {user}")
+            continue
+        users={}
+        for project,projdescr in projects:
+            try:
+                kbproject=kbclnt.getProjectByName(name=project)
+                assignee=projdescr.get("assignee")
+                if assignee and assignee not in users:
+                    users[assignee]=kbclnt.getUserByName(username=assignee)
+            except KBClientError as exc:
+                problems.append(f"{project}: cannot retrieve project/user from {url}: {exc}")
+                continue
+            if not kbproject:
+                problems.append(f"{project}: can not find kanboard project on {url}. Does it exist and do you have access?")
+                continue
+            projid=kbproject["id"]
+            config={"project":project,"url":url,"user":user,"apitoken":apitoken,"projid":projid,"assignee":"","lastsync":datetime(2000,1,1)}
+            if assignee:
+                if not users[assignee]:
+                    problems.append(f"{project}: unknown kanboard user {assignee}")
+                    continue
+                config["assignee"]={"user":assignee,"kbid":users[assignee]["id"]}
+            try:
+                categories=kbclnt.getAllCategories(project_id=projid)
+                swimlanes=kbclnt.getActiveSwimlanes(project_id=projid)
+                columns=kbclnt.getColumns(project_id=projid)
+            except KBClientError as exc:
+                problems.append(f"{project}: cannot retrieve project metadata: {exc}")
+                continue
+
+            mapper={}
+            mapper[catkey],catproblems=declarativeMap(categories,projdescr.get("categories"),"category")
+            mapper[swimkey],swimproblems=declarativeMap(swimlanes,projdescr.get("swimlanes"),"swimlane")
+            mapper[colkey],colproblems=declarativeColumns(columns,projdescr.get("columns"))
+            problems.extend([f"{project}: {problem}" for problem in catproblems+swimproblems+colproblems])
+            config["mapping"]=mapper
+            configs.append(config)
+
+    if problems:
+        return [],problems
+    return configs,problems
@@ -0,0 +1,108 @@
+# contains a local control interface (unix socket) of the daemon
+# Commands (sync, purge, status, metrics) sent by the command line script are queued and executed by the main loop of the daemon,
+# so they reuse its warm clients and database connections and never run concurrently with a scheduled sync
+
+import os
+import json
+import time
+import queue
+import socket
+import logging
+import threading
+
+def socketPath(dbpath):
+    """Default control socket of a daemon, next to its sync database"""
+    return os.path.splitext(dbpath)[0]+".sock"
+
+def sendCommand(path,request,timeout=3600):
+    """Send a command to a running daemon and return its reply (None when no daemon listens on path)"""
+    if not os.path.exists(path):
+        return None
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError as exc:
+            #stale socket of a daemon which is gone, or a daemon of another user
+            logging.debug(f"Cannot connect to {path}: {exc}")
+            return None
+        sock.settimeout(timeout)
+        sock.sendall((json.dumps(request)+"\n").encode())
+        with sock.makefile('r') as fid:
+            reply=fid.readline()
+    if not reply:
+        return None
+    return json.loads(reply)
+
+
+class ControlServer:
+    """Listens on one unix socket per profile and queues the received commands for the main loop"""
+    def __init__(self,paths):
+        #paths maps profile names to socket paths
+        self._requests=queue.Queue()
+        self._socks=[]
+        for name,path in paths.items():
+            self._socks.append(self._bind(path))
+            threading.Thread(target=self._accept,args=(name,self._socks[-1]),daemon=True).start()
+            logging.info(f"Listening for commands of profile {name} on {path}")
+
+    @staticmethod
+    def _bind(path):
+        if os.path.exists(path):
+            if sendCommand(path,{"command":"ping"},timeout=5) is not None:
+                raise RuntimeError(f"Another daemon is already listening on {path}")
+            os.unlink(path)
+        sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.bind(path)
+        #only the owner may control the daemon
+        os.chmod(path,0o600)
+        sock.listen()
+        return sock
+
+    def _accept(self,name,sock):
+        while True:
+            try:
+                clnt,_=sock.accept()
+            except OSError:
+                #socket was closed
+                return
+            try:
+                with clnt.makefile('r') as fid:
+                    request=json.loads(fid.readline())
+            except ValueError:
+                clnt.close()
+                continue
+            if request.get("command") == "ping":
+                #answered directly (used to detect running daemons)
+                self._reply(clnt,{"ok":True})
+                continue
+            self._requests.put((name,request,clnt))
+
+    @staticmethod
+    def _reply(clnt,reply):
+        try:
+            clnt.sendall((json.dumps(reply,default=str)+"\n").encode())
+        except OSError as exc:
+            logging.warning(f"Could not reply to control client: {exc}")
+        finally:
+            clnt.close()
+
+    def serve(self,timeout,handler):
+        """Execute queued commands with handler(name,request) until timeout (seconds) has passed"""
+        deadline=time.monotonic()+timeout
+        while True:
+            remaining=deadline-time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                name,request,clnt=self._requests.get(timeout=remaining)
+            except queue.Empty:
+                return
+            logging.info(f"Executing {request.get('command')} command of profile {name}")
+            self._reply(clnt,handler(name,request))
+
+    def close(self):
+        for sock in self._socks:
+            path=sock.getsockname()
+            sock.close()
+            if os.path.exists(path):
+                os.unlink(path)
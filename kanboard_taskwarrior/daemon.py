@@ -0,0 +1,101 @@
+# contains functionality to run the synchronization as a service
+# A single daemon process can serve multiple taskwarrior profiles (taskrc, data directory and sync database),
+# which share the kanboard client pool and the scheduling loop but keep their taskwarrior and sqlite state isolated
+
+import os
+import sys
+import json
+import time
+import logging
+from io import StringIO
+from contextlib import redirect_stdout
+from kanboard_taskwarrior.db import DbConnector
+from kanboard_taskwarrior.transport import policyStats
+
+def loadProfiles(registry,test=False,conflictpolicy="newest",twdirect=False):
+    """Load a registry (json file) of taskwarrior profiles and open a database connection for each of them
+    The registry maps profile names to taskrc, data directory and (optionally) sync database paths e.g.:
+    {"alice":{"taskrc":"/home/alice/.taskrc","data":"/home/alice/.task","db":"/home/alice/.task/taskw-sync-KB.sql"}}
+    """
+    with open(os.path.expanduser(registry),'r') as fid:
+        profiles=json.load(fid)
+
+    connectors={}
+    for name,profile in profiles.items():
+        datadir=profile.get("data")
+        dbpath=profile.get("db")
+        if not dbpath and datadir:
+            #default to a sync database in the taskwarrior data directory of the profile
+            dbpath=os.path.join(os.path.expanduser(datadir),"taskw-sync-KB.sql")
+        logging.info(f"Loading profile {name}")
+        connectors[name]=DbConnector(dbpath=dbpath,test=test,taskrc=profile.get("taskrc"),datadir=datadir,conflictpolicy=profile.get("conflictpolicy",conflictpolicy),twdirect=twdirect)
+    return connectors
+
+def handleCommand(conn,request,stats):
+    """Execute a command received through the control socket, returns the reply (printed output is sent back to the client)"""
+    command=request.get("command")
+    project=request.get("project")
+    output=StringIO()
+    try:
+        with redirect_stdout(output):
+            #the configuration may have been changed by the command line script in the meantime
+            conn.reload()
+            if command == "sync":
+                conn.syncTasks(project)
+                result=None
+            elif command == "purge":
+                if not project:
+                    raise ValueError("Purging deleted project tasks requires a project name")
+                conn.purgeTasks(project)
+                result=None
+            elif command == "status":
+                result=conn.status(project)
+            elif command == "metrics":
+                result={"transport":policyStats(),**stats}
+            else:
+                raise ValueError(f"Unknown command {command}")
+    except Exception as exc:
+        #a failing command must not take down the daemon
+        logging.error(f"Command {command} failed: {exc!r}")
+        return {"ok":False,"error":str(exc),"output":output.getvalue()}
+    return {"ok":True,"result":result,"output":output.getvalue()}
+
+def runDaemon(connectors,interval,project=None,maxfail=10,archivedays=None,control=None):
+    """Periodically synchronize all profiles
+    Profiles which fail more than maxfail times in a row are dropped from the schedule, the daemon stops when none are left
+    When archivedays is set, finished task links are archived and the databases are optimized once a day
+    When a control server is given, its commands are executed in between the scheduled syncs"""
+    nfail={name:0 for name in connectors}
+    started=time.time()
+    def handler(name,request):
+        stats={"uptime":round(time.time()-started),"failures":nfail[name]}
+        return handleCommand(connectors[name],request,stats)
+    while True:
+        for name,conn in connectors.items():
+            if nfail[name] > maxfail:
+                continue
+            try:
+                logging.debug(f"Synchronizing profile {name}")
+                conn.reload()
+                conn.syncTasks(project)
+                if archivedays is not None:
+                    conn.maintenance(archivedays)
+                #reset fail count
+                nfail[name]=0
+            except Exception as exc:
+                #a failing profile must not stop the synchronization of the others
+                logging.error(f"Synchronization of profile {name} failed: {exc!r}")
+                nfail[name]+=1
+                if nfail[name] > maxfail:
+                    #stop after repeated failed attempts
+                    logging.error(f"Stopping synchronization of profile {name} after repeated failures")
+                #ok try again next time
+
+        if all(nf > maxfail for nf in nfail.values()):
+            sys.exit(1)
+
+        logging.info(f"Sleeping for {interval} seconds")
+        if control is None:
+            time.sleep(interval)
+        else:
+            control.serve(interval,handler)
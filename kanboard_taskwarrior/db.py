@@ -2,22 +2,41 @@
 # contains functionality to interact with the sqlite database
 
 import os
+import sys
 import sqlite3
 from contextlib import closing
 import json
-from kanboard_taskwarrior.config import runConfig,configUDA
-from kanboard_taskwarrior.taskmap import twFromkbTask,kbFromtwTask
+from kanboard_taskwarrior.config import runConfig,configUDA,configUDAs,loadDeclarative,declarativeConfig
+from kanboard_taskwarrior.taskmap import twFromkbTask,kbFromtwTask,twFromState,kbFromState,stateFromtw,stateFromkb,mergeStates,conflictTag
 from kanboard_taskwarrior.clients import kbClient, twClient,TWDoesNotExist,KBClientError,TWClientError
+from kanboard_taskwarrior.snapshot import KBSnapshot,twExport,TWExportReader
+from kanboard_taskwarrior.twstore import TWStore
+from kanboard_taskwarrior.transport import isTransportError
 
 from uuid import uuid4
-from datetime import datetime
+import time
+from datetime import datetime,timedelta
 import logging
 
-def opendb(dbpath=None):
-        if not dbpath:
-            dbpath=os.path.join(os.path.expanduser('~'),".task/taskw-sync-KB.sql")
+def dbPath(dbpath=None):
+    """Path of the sync database (default uses ~/.task/taskw-sync-KB.sql)"""
+    if not dbpath:
+        dbpath=os.path.join(os.path.expanduser('~'),".task/taskw-sync-KB.sql")
+    return dbpath
+
+def opendb(dbpath=None,readonly=False,timeout=30):
+        dbpath=dbPath(dbpath)
+        conn=None
         try:
-            conn=sqlite3.connect(dbpath,detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            if readonly and os.path.exists(dbpath):
+                #read-only commands can run concurrently with a writing (daemon) process
+                conn=sqlite3.connect(f"file:{dbpath}?mode=ro",uri=True,timeout=timeout,detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            else:
+                conn=sqlite3.connect(dbpath,timeout=timeout,detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+                #write ahead logging: readers don't block the writer and vice versa
+                conn.execute("PRAGMA journal_mode=WAL")
+                #only fsync at checkpoints (safe in WAL mode, at most the last transactions are lost on power failure)
+                conn.execute("PRAGMA synchronous=NORMAL")
             conn.row_factory = sqlite3.Row
         except sqlite3.Error as e:
             print(e)
@@ -27,21 +46,99 @@ def opendb(dbpath=None):
 
         return conn
 
+class LinkBuffer:
+    """Buffers modifications of a link table and flushes them with executemany (one transaction per chunk)
+    When a chunk fails, its rows are retried one by one within savepoints, so only the offending rows are rolled back
+    sql may also be a tuple of statements, a row then holds the parameters of each statement (None skips it) which are written together"""
+    def __init__(self,dbcon,sql,chunksize=500):
+        self._dbcon=dbcon
+        self._multi=isinstance(sql,tuple)
+        self._sql=sql if self._multi else (sql,)
+        self._chunksize=chunksize
+        self._rows=[]
+
+    def add(self,row):
+        self._rows.append(row)
+        if len(self._rows) >= self._chunksize:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        rows=self._rows
+        self._rows=[]
+        #finish any pending (implicit) transaction first
+        self._dbcon.commit()
+        with closing(self._dbcon.cursor()) as cur:
+            cur.execute("BEGIN")
+            try:
+                for i,sql in enumerate(self._sql):
+                    cur.executemany(sql,[row[i] for row in self._params(rows) if row[i] is not None])
+            except sqlite3.Error as exc:
+                logging.warning(f"Chunked link update failed ({exc}), retrying row by row")
+                cur.execute("ROLLBACK")
+                cur.execute("BEGIN")
+                for row in self._params(rows):
+                    cur.execute("SAVEPOINT linkrow")
+                    try:
+                        for sql,params in zip(self._sql,row):
+                            if params is not None:
+                                cur.execute(sql,params)
+                    except sqlite3.Error as exc:
+                        logging.error(f"Could not update link {row}: {exc}")
+                        cur.execute("ROLLBACK TO linkrow")
+                    cur.execute("RELEASE linkrow")
+            cur.execute("COMMIT")
+
+    def _params(self,rows):
+        return rows if self._multi else [(row,) for row in rows]
+
 kbserverTable='kbserver'
 migrationTable='migrationhistory'
+maintenanceTable='maintenance'
+leaseTable='synclease'
+#lease row which guards the database maintenance (only one worker runs it at a time)
+maintenanceLease='#maintenance'
+#lease time (seconds) of a project which is synced from the command line alongside workers
+cliLeaseTtl=3600
+#prefix of the lease rows which register the presence of the workers
+workerLease='#worker:'
+archiveSuffix='_archive'
+mirrorSuffix='_kbmirror'
+feedTable='changefeed'
+#kanboard returns (at most) the 50 latest activity events of a project
+feedLimit=50
+#above this number of changed tasks a single search is cheaper than fetching the tasks one by one
+feedMaxTasks=25
+#how often the change feed is verified with a full search (and the links are reconciled with the tasks of the project)
+feedFullcheck=timedelta(days=1)
+
+def syncTableName(projname):
+    """Name of the table where the synced entries of a project can be found"""
+    return f"{projname.lower().replace(' ','_')}_tasks"
 
 class DbConnector:
     """A class which connects toa  sqlite database and adds functionality to work with a sync-project"""
-    clientversion=3
-    def __init__(self,dbpath=None,test=False):
-
-        self._dbcon=opendb(dbpath)
-        #possibly migrate existing database first
-        self.migrateCheck()
-        #initialize the kberserver table if it doesn't exists
-        self._initTable()
+    clientversion=5
+    def __init__(self,dbpath=None,test=False,taskrc=None,datadir=None,readonly=False,conflictpolicy="newest",twdirect=False):
+
+        self.dbpath=dbPath(dbpath)
+        self._dbcon=opendb(self.dbpath,readonly=readonly)
+        #taskwarrior instance to sync with (default one when not set)
+        self._taskrc=taskrc
+        self._datadir=datadir
+        #read taskwarrior state directly from the taskwarrior 3 database
+        self._twdirect=twdirect
+        self._twstore=None
+        if not readonly:
+            #possibly migrate existing database first
+            self.migrateCheck()
+            #initialize the kberserver table if it doesn't exists
+            self._initTable()
         self._syncentries={}
         self._test=test
+        #how to resolve fields which are changed differently on both sides
+        self._conflictpolicy=conflictpolicy
 
     def _initTable(self,tableName=kbserverTable):
         """create the dedicated server table if it doesn't exists yet
@@ -56,6 +153,35 @@ class DbConnector:
                 cur.execute(f"""
                 CREATE TABLE {tableName} (url TEXT, apitoken TEXT, user TEXT, project TEXT UNIQUE, projid INT, assignee TEXT, mapping json, lastsync TIMESTAMP,PRIMARY KEY(project))
                 """)
+        elif tableName == leaseTable:
+            with self.newcur() as cur:
+                #expiry times are stored as unix timestamps (note: workers may start concurrently)
+                cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {tableName} (project TEXT UNIQUE, owner TEXT, expires REAL DEFAULT 0,PRIMARY KEY(project))
+                """)
+        elif tableName == maintenanceTable:
+            with self.newcur() as cur:
+                cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {tableName} (task TEXT UNIQUE, lastrun TIMESTAMP,PRIMARY KEY(task))
+                """)
+        elif tableName == feedTable:
+            with self.newcur() as cur:
+                #cursor (last seen activity event) of the kanboard change feed of each project
+                cur.execute(f"""
+                CREATE TABLE {tableName} (project TEXT UNIQUE, lastevent INT, fullcheck TIMESTAMP,PRIMARY KEY(project))
+                """)
+        elif tableName.endswith(mirrorSuffix):
+            with self.newcur() as cur:
+            #create a table which mirrors the mapped fields of the linked kanboard tasks
+                cur.execute(f"""
+                CREATE TABLE {tableName} (kbid INT UNIQUE, title TEXT, date_due INT, column_id INT, swimlane_id INT, category_id INT, owner_id INT, is_active INT, date_modification INT, position INT DEFAULT 0, PRIMARY KEY(kbid))
+                """)
+        elif tableName.endswith(archiveSuffix):
+            with self.newcur() as cur:
+            #create a table with archived links of finished tasks
+                cur.execute(f"""
+                CREATE TABLE {tableName} (uuid TEXT UNIQUE, kbid INT UNIQUE, lastsync TEXT, base json, archived TIMESTAMP)
+                """)
         elif tableName == migrationTable:
             with self.newcur() as cur:
                 cur.execute(f"""
@@ -64,9 +190,9 @@ class DbConnector:
         else:
                 
             with self.newcur() as cur:
-            #create a table with synced entries for a dedicated project
+            #create a table with synced entries for a dedicated project (base holds the last synced state of the mapped fields)
                 cur.execute(f"""
-                CREATE TABLE {tableName} (uuid TEXT UNIQUE, kbid INT UNIQUE, lastsync TEXT)
+                CREATE TABLE {tableName} (uuid TEXT UNIQUE, kbid INT UNIQUE, lastsync TEXT, base json)
                 """)
     
     def setMigration(self,version,minversion=0):
@@ -118,10 +244,87 @@ class DbConnector:
                 self.setMigration(3,3)
                 dbversion=3
 
+        if dbversion < 4:
+            #add a column with the last synced state to the link tables (used for three-way merges)
+            logging.info("Migratiing database to version 4")
+            with self.newcur() as cur:
+                projects=[]
+                if self.tableExists(kbserverTable):
+                    projects=[row['project'] for row in cur.execute(f"SELECT project FROM {kbserverTable}")]
+                for project in projects:
+                    for table in (syncTableName(project),syncTableName(project)+archiveSuffix):
+                        if self.tableExists(table):
+                            cur.execute(f"ALTER TABLE {table} ADD COLUMN base json")
+                self._dbcon.commit()
+                self.setMigration(4)
+                dbversion=4
+
+        if dbversion < 5:
+            #add the position within the column to the kanboard mirror tables
+            logging.info("Migratiing database to version 5")
+            with self.newcur() as cur:
+                projects=[]
+                if self.tableExists(kbserverTable):
+                    projects=[row['project'] for row in cur.execute(f"SELECT project FROM {kbserverTable}")]
+                for project in projects:
+                    if self.tableExists(syncTableName(project)+mirrorSuffix):
+                        cur.execute(f"ALTER TABLE {syncTableName(project)+mirrorSuffix} ADD COLUMN position INT DEFAULT 0")
+                self._dbcon.commit()
+                self.setMigration(5)
+                dbversion=5
+
         # add other migration strategies
-        # if migration['version'] < 4 ....
+        # if migration['version'] < 6 ....
+
+
+
+    def _twClient(self):
+        return twClient(taskrc=self._taskrc,datadir=self._datadir)
+
+    def _twReader(self,twclnt):
+        """Returns the reader of taskwarrior snapshots (direct database access or task export)"""
+        if self._twdirect:
+            if self._twstore is None:
+                self._twstore=TWStore.fromClient(twclnt,self._datadir)
+            if self._twstore is not None:
+                return self._twstore
+        return TWExportReader(twclnt)
 
+    def _mirrorBuffer(self,projconf):
+        """Returns a buffer for write-through updates of the kanboard mirror table"""
+        self._initTable(projconf['mirrortable'])
+        return LinkBuffer(self._dbcon,self._mirrorSql(projconf))
 
+    @staticmethod
+    def _mirrorSql(projconf):
+        return f"INSERT OR REPLACE INTO {projconf['mirrortable']} (kbid,title,date_due,column_id,swimlane_id,category_id,owner_id,is_active,date_modification,position) VALUES (?,?,?,?,?,?,?,?,?,?)"
+
+    def _mirrorGet(self,projconf,kbid):
+        """Returns the mirrored snapshot of a kanboard task (or None)"""
+        if not self.tableExists(projconf['mirrortable']):
+            return None
+        with self.newcur() as cur:
+            row=cur.execute(f"SELECT * FROM {projconf['mirrortable']} WHERE kbid = ?",(kbid,)).fetchone()
+        return KBSnapshot.fromrow(row) if row else None
+
+    def status(self,projectname=None):
+        """Summarize the state of the project links from the local database only (no server contact)"""
+        self._fillentries()
+        summary={}
+        for project,projconf in self._syncentries.items():
+            if projectname is not None and projectname != project:
+                continue
+            stat={"url":projconf["url"],"lastsync":str(projconf["lastsync"]),"links":0,"archived":0,"open":0,"closed":0}
+            with self.newcur() as cur:
+                if self.tableExists(projconf['synctable']):
+                    stat["links"]=cur.execute(f"SELECT COUNT(*) FROM {projconf['synctable']}").fetchone()[0]
+                if self.tableExists(projconf['archivetable']):
+                    stat["archived"]=cur.execute(f"SELECT COUNT(*) FROM {projconf['archivetable']}").fetchone()[0]
+                if self.tableExists(projconf['mirrortable']):
+                    for row in cur.execute(f"SELECT is_active,COUNT(*) AS ntasks FROM {projconf['mirrortable']} GROUP BY is_active"):
+                        stat["open" if row['is_active'] else "closed"]=row['ntasks']
+            summary[project]=stat
+        return summary
 
     def newcur(self):
         return closing(self._dbcon.cursor())
@@ -149,10 +352,17 @@ class DbConnector:
     def __getitem__(self,key):
         return self._syncentries[key]
 
+    def reload(self):
+        """Forget the cached sync entries, so changes made by other processes (e.g. newly configured projects) are picked up"""
+        self._syncentries={}
+
     def _fillentries(self):
         """fill sync entries if it is not done already"""
         if self._syncentries:
             return
+        if not self.tableExists(kbserverTable):
+            #e.g. a pristine database opened read-only
+            return
         with self.newcur() as cur:
             res=cur.execute(f"SELECT * from {kbserverTable}").fetchall()
 
@@ -173,8 +383,12 @@ class DbConnector:
                 self._syncentries[projname]["assignee"]=assignee
 
                 #add the table name wher ethe synced entries can be found
-                synctablename=f"{projname.lower().replace(' ','_')}_tasks"
+                synctablename=syncTableName(projname)
                 self._syncentries[projname]["synctable"]=synctablename
+                #table with the links of finished tasks
+                self._syncentries[projname]["archivetable"]=f"{synctablename}{archiveSuffix}"
+                #table with the last known state of the linked kanboard tasks
+                self._syncentries[projname]["mirrortable"]=f"{synctablename}{mirrorSuffix}"
 
 
 
@@ -186,6 +400,68 @@ class DbConnector:
                 self._dbcon.commit()
 
 
+    def _setFeed(self,projname,lastevent,fullcheck=None):
+        """Advance the cursor of the kanboard change feed (and the time of the last full check)"""
+        if self._test or lastevent is None:
+            return
+        self._initTable(feedTable)
+        with self._dbcon:
+            if fullcheck is None:
+                self._dbcon.execute(f"UPDATE {feedTable} SET lastevent = ? WHERE project = ?",(lastevent,projname))
+            else:
+                self._dbcon.execute(f"INSERT OR REPLACE INTO {feedTable} (project,lastevent,fullcheck) VALUES (?,?,?)",(projname,lastevent,fullcheck))
+
+    def _kbSearch(self,kbclnt,projconf):
+        """Search for the kanboard tasks modified since the last sync"""
+        qry=f"modified:>={int(projconf['lastsync'].timestamp())}"
+        if projconf["assignee"]:
+            qry+=f" assignee:{projconf['assignee']['user']}"
+        return [KBSnapshot.fromjson(el) for el in kbclnt.searchTasks(project_id=projconf["projid"],query=qry)]
+
+    def _kbChanges(self,kbclnt,projconf):
+        """Retrieve the kanboard tasks modified since the last sync from the project activity feed
+        Only the tasks which appear in events after the stored cursor are fetched. A full search is done instead when there is no cursor yet,
+        when events may have been missed or when the last full check is too long ago
+        Returns the task snapshots, the new cursor and whether a full check was done"""
+        cursor=None
+        fullcheck=None
+        if self.tableExists(feedTable):
+            with self.newcur() as cur:
+                row=cur.execute(f"SELECT lastevent,fullcheck FROM {feedTable} WHERE project = ?",(projconf['project'],)).fetchone()
+            if row is not None:
+                cursor,fullcheck=row['lastevent'],row['fullcheck']
+
+        events=kbclnt.getProjectActivity(project_id=projconf["projid"]) or []
+        lastevent=max([int(ev['id']) for ev in events],default=cursor or 0)
+
+        if cursor is None or fullcheck is None or datetime.now()-fullcheck > feedFullcheck:
+            logging.debug(f"Full consistency check of Kanboard project {projconf['project']}")
+            return self._kbSearch(kbclnt,projconf),lastevent,True
+
+        newevents=[ev for ev in events if int(ev['id']) > cursor]
+        if len(newevents) == len(events) and len(events) >= feedLimit:
+            #the cursor is not in the returned window anymore, so events may have been missed
+            logging.debug("Change feed overflowed, searching for modified Kanboard tasks")
+            return self._kbSearch(kbclnt,projconf),lastevent,False
+
+        #only the event ids are compared (event times are not reliable under clock skew or while a sync is running)
+        taskids={int(ev['task_id']) for ev in newevents if ev.get('task_id')}
+        if len(taskids) > feedMaxTasks:
+            return self._kbSearch(kbclnt,projconf),lastevent,False
+
+        kbtasks=[]
+        for taskid in taskids:
+            kbtask=kbclnt.getTask(task_id=taskid)
+            if not kbtask or int(kbtask['project_id']) != int(projconf["projid"]):
+                #deleted or moved to another project, reconciled by the purge after the next full check
+                continue
+            kbtask=KBSnapshot.fromjson(kbtask)
+            if projconf["assignee"] and kbtask.owner != int(projconf['assignee']['kbid']):
+                continue
+            kbtasks.append(kbtask)
+        logging.debug(f"Change feed of Kanboard project {projconf['project']}: {len(newevents)} events, {len(kbtasks)} modified tasks")
+        return kbtasks,lastevent,False
+
     def remove(self,projname):
         """Remove a synchronization instance if it exists"""
         self._fillentries()
@@ -194,7 +470,11 @@ class DbConnector:
             if not self._test:
                 with self.newcur() as cur:
                     cur.execute(f"DROP TABLE {self._syncentries[projname]['synctable']}")
+                    cur.execute(f"DROP TABLE IF EXISTS {self._syncentries[projname]['archivetable']}")
+                    cur.execute(f"DROP TABLE IF EXISTS {self._syncentries[projname]['mirrortable']}")
                     cur.execute(f"DELETE FROM {kbserverTable} WHERE project = '{projname}'")
+                    if self.tableExists(feedTable):
+                        cur.execute(f"DELETE FROM {feedTable} WHERE project = ?",(projname,))
                 self._dbcon.commit()
         else:
             logging.info(f"Project link {projname} does not exist and needs no deletion")
@@ -207,7 +487,7 @@ class DbConnector:
             projconf={}
         config=runConfig(projectname,projconf)
         #configure taskwarrior uda's
-        configUDA(config["mapping"])
+        configUDA(config["mapping"],self._twClient())
         #store the configuration in the database
         with self.newcur() as cur:
             #convert mapping to json string
@@ -225,6 +505,36 @@ class DbConnector:
             #actually commit the changes to the database
             self._dbcon.commit()
     
+    def applyConfig(self,path):
+        """Register (or update) the project links described in a declarative json/toml file without prompting
+        Everything is validated before anything is written, the links are stored in a single transaction"""
+        configs,problems=declarativeConfig(loadDeclarative(path))
+        if problems:
+            for problem in problems:
+                logging.error(problem)
+            logging.error(f"Not applying {path}")
+            sys.exit(1)
+
+        if self._test:
+            for config in configs:
+                print(f"Would register project {config['project']} found at {config['url']}")
+            return
+
+        #configure the taskwarrior uda's of all projects in one go
+        configUDAs([config["mapping"] for config in configs],self._twClient())
+
+        values=[(config["url"],config["user"],config["apitoken"],config["project"],config["projid"],config["lastsync"],json.dumps(config["mapping"]),json.dumps(config["assignee"]) if config["assignee"] else "") for config in configs]
+        with self._dbcon:
+            #existing links keep their sync state unless they point to another kanboard project now
+            self._dbcon.executemany(f"""
+                INSERT INTO {kbserverTable} (url,user,apitoken,project,projid,lastsync,mapping,assignee) VALUES (?,?,?,?,?,?,?,?)
+                ON CONFLICT(project) DO UPDATE SET url = excluded.url, user = excluded.user, apitoken = excluded.apitoken, mapping = excluded.mapping, assignee = excluded.assignee,
+                lastsync = CASE WHEN {kbserverTable}.projid = excluded.projid AND {kbserverTable}.url = excluded.url THEN {kbserverTable}.lastsync ELSE excluded.lastsync END,
+                projid = excluded.projid
+                """,values)
+        self.reload()
+        print(f"Registered {len(configs)} project links from {path}")
+
     def purgeTasks(self,projectname):
         """Delete tasks which were synced but for which one entry has been deleted"""
         self._fillentries()
@@ -237,16 +547,29 @@ class DbConnector:
             logging.error("Cannot reach kanboard instance")
             return
          
-        twclnt=twClient()
+        twclnt=self._twClient()
+        twreader=self._twReader(twclnt)
 
         with self.newcur() as cur:
-            syncedtasks=cur.execute(f"SELECT * from {projconf['synctable']}")
+            syncedtasks=cur.execute(f"SELECT * from {projconf['synctable']}").fetchall()
 
+        #retrieve all (open and closed) kanboard tasks of the project at once instead of one call per link
+        kbexisting={}
+        for status in (1,0):
+            for el in kbclnt.getAllTasks(project_id=projconf['projid'],status_id=status):
+                kbtask=KBSnapshot.fromjson(el)
+                kbexisting[kbtask.id]=kbtask
+
+        #obsolete links (and their mirrored kanboard state) are deleted in chunks
+        obsolete=LinkBuffer(self._dbcon,f"DELETE FROM {projconf['synctable']} WHERE uuid = ? and kbid = ?")
+        mirror=self._mirrorBuffer(projconf)
+        unmirror=LinkBuffer(self._dbcon,f"DELETE FROM {projconf['mirrortable']} WHERE kbid = ?")
+        try:
             for tasklink in syncedtasks:
                 #check whether the entry is not deleted in taskwarrior
                 twWasDeleted=False            
                 try:
-                    twtask=twclnt.tasks.get(uuid=tasklink['uuid'])
+                    twtask=twreader.get(tasklink['uuid'])
                     if twtask.deleted:
                         twWasDeleted=True
 
@@ -260,15 +583,26 @@ class DbConnector:
                     twWasDeleted=True            
                 
                 kbWasDeleted=False
-                try:
-                    kbtask=kbclnt.getTask(task_id=tasklink['kbid'])
-                    if 'assignee' in projconf and bool(projconf['assignee']):
-                        if kbtask['owner_id'] != projconf['assignee']['kbid']:
-                            #this will remove taskwarrior task which were not assigned to the assignee
-                            kbWasDeleted=True
-                except KBClientError:
-                    # task cannot be found/accessed anymore
-                    kbWasDeleted=True
+                kbtask=kbexisting.get(tasklink['kbid'])
+                if kbtask is None:
+                    #the listing only holds the tasks of this project, so make sure the task is really gone
+                    kbjson=self._kbLookup(kbclnt,tasklink['kbid'])
+                    if kbjson is None:
+                        # task cannot be found/accessed anymore
+                        kbWasDeleted=True
+                    elif int(kbjson['project_id']) != int(projconf['projid']):
+                        #moved to another project: keep both tasks but stop syncing them here
+                        logging.info(f"Kanboard task {tasklink['kbid']} moved to project {kbjson['project_id']}, removing its link")
+                        if not self._test:
+                            obsolete.add((tasklink['uuid'],tasklink['kbid']))
+                            unmirror.add((tasklink['kbid'],))
+                        continue
+                    else:
+                        kbtask=KBSnapshot.fromjson(kbjson)
+                if kbtask is not None and 'assignee' in projconf and bool(projconf['assignee']):
+                    if kbtask.owner != int(projconf['assignee']['kbid']):
+                        #this will remove taskwarrior task which were not assigned to the assignee
+                        kbWasDeleted=True
                 
                 if twWasDeleted and not kbWasDeleted:
                     #remove kanboard task
@@ -283,6 +617,8 @@ class DbConnector:
                     #remove taskwarrior task
                     logging.info(f"removing obsolete taskwarrior task {tasklink['uuid']}")
                     if not self._test:
+                        #load the full task only for the actual deletion
+                        twtask=twclnt.tasks.get(uuid=tasklink['uuid'])
                         twtask.delete()
                         twtask.save()
                 
@@ -291,28 +627,198 @@ class DbConnector:
                     
                     logging.info("Removing obsolete link from database")
                     if not self._test:
-                        with self.newcur() as cur:
-                            cur.execute(f"DELETE FROM {projconf['synctable']} WHERE uuid = ? and kbid = ?",(tasklink['uuid'],tasklink['kbid']))
-                        
-                        self._dbcon.commit()
+                        obsolete.add((tasklink['uuid'],tasklink['kbid']))
+                        unmirror.add((tasklink['kbid'],))
+                elif not self._test:
+                    #refresh the mirror while we're at it
+                    mirror.add(kbtask.astuple())
+        finally:
+            obsolete.flush()
+            mirror.flush()
+            unmirror.flush()
 
             
 
-    def syncTasks(self,projectname=None):
+    @staticmethod
+    def _kbLookup(kbclnt,kbid):
+        """Returns a single kanboard task (json) or None when it does not exist or is inaccessible, transport errors are raised"""
+        try:
+            return kbclnt.getTask(task_id=kbid) or None
+        except KBClientError as exc:
+            if isTransportError(exc):
+                raise
+            return None
+
+    def archiveLinks(self,projectname,days=30):
+        """Move links to the archive table when both tasks have been completed/closed for more than the given number of days"""
+        self._fillentries()
+        projconf=self._syncentries[projectname]
+
+        kbclnt=kbClient(projconf["url"],projconf["user"],projconf["apitoken"])
+        if kbclnt is None:
+            logging.error("Cannot reach kanboard instance")
+            return
+
+        twclnt=self._twClient()
+        cutoff=datetime.now()-timedelta(days=days)
+        
+        #closed kanboard tasks (status_id=0) and long completed taskwarrior tasks (one call each)
+        kbfinished=set(int(el['id']) for el in kbclnt.getAllTasks(project_id=projconf['projid'],status_id=0) if 0 < int(el['date_completed'] or 0) < cutoff.timestamp())
+        twfinished=set(el.uuid for el in twExport(twclnt,twclnt.tasks.filter(project=projconf['project'],status="completed",end__before=cutoff)))
+
+        self._initTable(projconf['synctable'])
+        with self.newcur() as cur:
+            links=cur.execute(f"SELECT uuid,kbid FROM {projconf['synctable']}").fetchall()
+        
+        finished=[(link['uuid'],link['kbid']) for link in links if link['kbid'] in kbfinished and link['uuid'] in twfinished]
+        logging.info(f"Archiving {len(finished)} links of finished tasks in project {projectname}")
+        if self._test or not finished:
+            return
+
+        self._initTable(projconf['archivetable'])
+        #move the links in a single transaction
+        self._dbcon.commit()
+        with self._dbcon:
+            now=datetime.now()
+            self._dbcon.executemany(f"""INSERT OR REPLACE INTO {projconf['archivetable']} (uuid,kbid,lastsync,base,archived)
+                SELECT uuid,kbid,lastsync,base,? FROM {projconf['synctable']} WHERE uuid = ? AND kbid = ?""",[(now,)+link for link in finished])
+            self._dbcon.executemany(f"DELETE FROM {projconf['synctable']} WHERE uuid = ? AND kbid = ?",finished)
+            if self.tableExists(projconf['mirrortable']):
+                self._dbcon.executemany(f"DELETE FROM {projconf['mirrortable']} WHERE kbid = ?",[(kbid,) for uuid,kbid in finished])
+
+    def maintenance(self,archivedays=30,interval=timedelta(days=1),force=False):
+        """Archive finished task links and optimize the database (runs at most once per interval unless forced)"""
+        try:
+            self._maintenance(archivedays,interval,force)
+        except sqlite3.OperationalError as exc:
+            #e.g. the database is locked by another process, the run is not registered so it is retried next time
+            self._dbcon.rollback()
+            logging.error(f"Database maintenance failed, retrying at the next run: {exc}")
+
+    def _maintenance(self,archivedays,interval,force):
+        self._initTable(maintenanceTable)
+        with self.newcur() as cur:
+            lastrun=cur.execute(f"SELECT lastrun FROM {maintenanceTable} WHERE task = 'maintenance'").fetchone()
+        if not force and lastrun is not None and lastrun['lastrun'] > datetime.now()-interval:
+            logging.debug("No database maintenance needed yet")
+            return
+        
+        self._fillentries()
+        for project in self._syncentries:
+            try:
+                self.archiveLinks(project,archivedays)
+            except KBClientError as exc:
+                logging.error(f"Could not archive links of project {project}: {exc}")
+
+        if self._test:
+            return
+        logging.info("Optimizing the sync database")
+        self._dbcon.commit()
+        self._dbcon.execute("ANALYZE")
+        #note: vacuum can not run inside a transaction
+        self._dbcon.execute("VACUUM")
+        with self.newcur() as cur:
+            cur.execute(f"INSERT OR REPLACE INTO {maintenanceTable} (task,lastrun) VALUES ('maintenance',?)",(datetime.now(),))
+        self._dbcon.commit()
+
+    def claimProjects(self,worker,ttl=300,release=True):
+        """Claim (a fair share of) the projects to be synced by a worker, returns the projects leased by the worker
+        Leases which are not renewed within ttl seconds expire and can be claimed by other workers.
+        The share follows from the number of live workers, which register their presence in a lease row of their own,
+        so the projects of a crashed worker are taken over by the remaining workers once its leases expire
+        Surplus projects are only released when release is set (i.e. not while the worker may be syncing them)"""
+        self._initTable(leaseTable)
+        self._dbcon.commit()
+        now=time.time()
+        with self.newcur() as cur:
+            #take the write lock up front so claims of different workers don't interleave
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(f"INSERT OR IGNORE INTO {leaseTable} (project,owner,expires) SELECT project,NULL,0 FROM {kbserverTable}")
+                #note: rows starting with # are not projects (presence of the workers and the maintenance lease)
+                cur.execute(f"DELETE FROM {leaseTable} WHERE project NOT IN (SELECT project FROM {kbserverTable}) AND project NOT LIKE '#%'")
+                cur.execute(f"INSERT OR REPLACE INTO {leaseTable} (project,owner,expires) VALUES (?,?,?)",(workerLease+worker,worker,now+ttl))
+                cur.execute(f"DELETE FROM {leaseTable} WHERE project LIKE '{workerLease}%' AND expires <= ?",(now,))
+                nworkers=cur.execute(f"SELECT COUNT(*) FROM {leaseTable} WHERE project LIKE '{workerLease}%'").fetchone()[0]
+                nprojects=cur.execute(f"SELECT COUNT(*) FROM {leaseTable} WHERE project NOT LIKE '#%'").fetchone()[0]
+                share=-(-nprojects//nworkers)
+                held=[row['project'] for row in cur.execute(f"SELECT project FROM {leaseTable} WHERE owner = ? AND expires > ? AND project NOT LIKE '#%' ORDER BY project",(worker,now))]
+                if len(held) < share:
+                    #claim free or expired projects (e.g. of crashed workers)
+                    cur.execute(f"""UPDATE {leaseTable} SET owner = ?, expires = ? WHERE project IN 
+                        (SELECT project FROM {leaseTable} WHERE (owner IS NULL OR expires <= ?) AND project NOT LIKE '#%' ORDER BY project LIMIT ?)""",(worker,now+ttl,now,share-len(held)))
+                elif len(held) > share and release:
+                    #release surplus projects (e.g. when workers were added or restarted)
+                    cur.executemany(f"UPDATE {leaseTable} SET owner = NULL, expires = 0 WHERE project = ? AND owner = ?",[(project,worker) for project in held[share:]])
+                cur.execute(f"UPDATE {leaseTable} SET expires = ? WHERE owner = ? AND expires > ?",(now+ttl,worker,now))
+                projects=[row['project'] for row in cur.execute(f"SELECT project FROM {leaseTable} WHERE owner = ? AND project NOT LIKE '#%' ORDER BY project",(worker,))]
+                cur.execute("COMMIT")
+            except sqlite3.Error:
+                cur.execute("ROLLBACK")
+                raise
+        return projects
+
+    def liveWorkers(self):
+        """Number of workers which registered their presence and did not expire"""
+        if not self.tableExists(leaseTable):
+            return 0
+        with self.newcur() as cur:
+            return cur.execute(f"SELECT COUNT(*) FROM {leaseTable} WHERE project LIKE '{workerLease}%' AND expires > ?",(time.time(),)).fetchone()[0]
+
+    def claimMaintenance(self,worker,ttl=300):
+        """Try to obtain the maintenance lease, returns whether the worker holds it"""
+        return self.acquireLease(worker,maintenanceLease,ttl)
+
+    def acquireLease(self,owner,project,ttl=300):
+        """Try to obtain a single lease (when it is free, expired or already held by owner), returns whether owner holds it"""
+        self._initTable(leaseTable)
+        self._dbcon.commit()
+        now=time.time()
+        with self._dbcon:
+            self._dbcon.execute(f"INSERT OR IGNORE INTO {leaseTable} (project,owner,expires) VALUES (?,NULL,0)",(project,))
+            self._dbcon.execute(f"UPDATE {leaseTable} SET owner = ?, expires = ? WHERE project = ? AND (owner IS NULL OR owner = ? OR expires <= ?)",(owner,now+ttl,project,owner,now))
+        return self.holdsLease(owner,project)
+
+    def releaseLease(self,worker,project):
+        with self.newcur() as cur:
+            cur.execute(f"UPDATE {leaseTable} SET owner = NULL, expires = 0 WHERE project = ? AND owner = ?",(project,worker))
+        self._dbcon.commit()
+
+    def holdsLease(self,worker,project):
+        with self.newcur() as cur:
+            row=cur.execute(f"SELECT owner FROM {leaseTable} WHERE project = ? AND expires > ?",(project,time.time())).fetchone()
+        return row is not None and row['owner'] == worker
+
+    def releaseLeases(self,worker):
+        with self.newcur() as cur:
+            cur.execute(f"UPDATE {leaseTable} SET owner = NULL, expires = 0 WHERE owner = ?",(worker,))
+        self._dbcon.commit()
+
+    def syncTasks(self,projectname=None,lease=None):
+        """Synchronize all (or a single) project
+        When lease (an owner name) is given and workers coordinate through leases, a project is only synced when its lease can be obtained"""
         self._fillentries()
         for project,entry in self._syncentries.items():
             if projectname is not None and projectname != project:
                 continue
-            #create the sync table if it doesn't exist
-            #sync the tasks of a single project 
-            self.syncSingle(entry)
+            if lease is None or not self.tableExists(leaseTable):
+                #sync the tasks of a single project 
+                self.syncSingle(entry)
+                continue
+            if not self.acquireLease(lease,project,cliLeaseTtl):
+                logging.warning(f"Project {project} is being synchronized by a worker, skipping")
+                continue
+            try:
+                self.syncSingle(entry)
+            finally:
+                self.releaseLease(lease,project)
 
     
     def syncSingle(self,projconf):
         """sync a single project"""
         
         #initialize a taskwarrior client
-        twclnt=twClient()
+        twclnt=self._twClient()
 
         # Initialize kanboard client and check for connectivity
         kbclnt=kbClient(projconf["url"],projconf["user"],projconf["apitoken"])
@@ -331,16 +837,15 @@ class DbConnector:
         synctaskTable=projconf['synctable']
 
         
-        # Retrieve recently modified tasks from kanboard
-        qry=f"modified:>={int(projconf['lastsync'].timestamp())}"
-        if projconf["assignee"]:
-            qry+=f" assignee:{projconf['assignee']['user']}"
-        kbtasks=kbclnt.searchTasks(project_id=projconf["projid"],query=qry)
-        #remove conflicts (don't resync these back to taskwarrior as it will create infinite growth)
-        kbtasks=[el for el in kbtasks if not el["title"].startswith("CONFLICT")]
+        # Retrieve recently modified tasks from kanboard (through the change feed)
+        kbchanged,lastevent,fullcheck=self._kbChanges(kbclnt,projconf)
+        #only compact snapshots of the tasks are kept in memory (indexed by id/uuid)
+        #remove conflict copies made by older versions (don't resync these back to taskwarrior as it will create infinite growth)
+        kbtasks={el.id:el for el in kbchanged if not el.title.startswith("CONFLICT")}
         #retriev modified tasks from taskwarrior
 
-        twtasks=twclnt.tasks.filter(project=projconf['project'],modified__after=projconf['lastsync'],status__not="Deleted").filter(status__not="Recurring")
+        twreader=self._twReader(twclnt)
+        twtasks={el.uuid:el for el in twreader.changedSince(projconf['project'],projconf['lastsync'])}
        ## CREATE tables to figure out which tasks are new and which ones need to be syncrhoinzed
         with self.newcur() as cur:
             cur.execute(f"DROP TABLE IF EXISTS {lastmodTable}")#note: probably not needed for temp tables
@@ -348,21 +853,34 @@ class DbConnector:
 
         #insert twtask modified uuid's
             if len(twtasks) > 0:
-                cur.executemany(f"INSERT INTO {lastmodTable} (uuid,twmod) VALUES (?,?)",[(el['uuid'],el['modified'].replace(tzinfo=None)) for el in twtasks])
+                cur.executemany(f"INSERT INTO {lastmodTable} (uuid,twmod) VALUES (?,?)",[(el.uuid,el.modified) for el in twtasks.values()])
 
             #insert new kanboard task id's
             if len(kbtasks) > 0:
-                cur.executemany(f"INSERT INTO {lastmodTable} (kbid,kbmod) VALUES (?,?)",[(el['id'],datetime.fromtimestamp(int(el['date_modification']))) for el in kbtasks])
+                cur.executemany(f"INSERT INTO {lastmodTable} (kbid,kbmod) VALUES (?,?)",[(el.id,el.lastmod) for el in kbtasks.values()])
+
+            #restore archived links of tasks which have been modified (e.g. reopened) again
+            archiveTable=projconf['archivetable']
+            if not self._test and self.tableExists(archiveTable):
+                cur.execute(f"""
+                    INSERT OR REPLACE INTO {synctaskTable} (uuid,kbid,lastsync,base)
+                    SELECT arch.uuid,arch.kbid,arch.lastsync,arch.base FROM {archiveTable} AS arch
+                    JOIN {lastmodTable} AS lmod
+                    ON arch.uuid = lmod.uuid OR arch.kbid = lmod.kbid
+                    """)
+                if cur.rowcount > 0:
+                    logging.info(f"Restored {cur.rowcount} archived task links")
+                    cur.execute(f"DELETE FROM {archiveTable} WHERE uuid IN (SELECT uuid FROM {synctaskTable}) OR kbid IN (SELECT kbid FROM {synctaskTable})")
             
 
             cur.execute(f"DROP TABLE IF EXISTS {needsyncTable}")#note: probably not needed for temp tables
-            cur.execute(f"CREATE TABLE {needsyncTable} (uuid TEXT , kbid INT , twmod TIMESTAMP, kbmod TIMESTAMP, lastsync TIMESTAMP ) ")
+            cur.execute(f"CREATE TABLE {needsyncTable} (uuid TEXT , kbid INT , twmod TIMESTAMP, kbmod TIMESTAMP, lastsync TIMESTAMP, base TEXT, linked INT ) ")
 
             
 
             cur.execute(f"""
-                INSERT INTO {needsyncTable} (kbid,uuid,twmod,kbmod,lastsync) 
-                SELECT IFNULL(synct.kbid,lmod.kbid) AS kbid, IFNULL(synct.uuid,lmod.uuid) AS uuid,lmod.twmod AS twmod, lmod.kbmod AS kbmod, synct.lastsync AS lastsync
+                INSERT INTO {needsyncTable} (kbid,uuid,twmod,kbmod,lastsync,base,linked) 
+                SELECT IFNULL(synct.kbid,lmod.kbid) AS kbid, IFNULL(synct.uuid,lmod.uuid) AS uuid,lmod.twmod AS twmod, lmod.kbmod AS kbmod, synct.lastsync AS lastsync, synct.base AS base, synct.kbid IS NOT NULL AS linked
                 FROM {lastmodTable} as lmod
                 LEFT JOIN {synctaskTable} as synct
                 ON synct.uuid = lmod.uuid OR synct.kbid = lmod.kbid
@@ -371,7 +889,7 @@ class DbConnector:
             cur.execute(f"UPDATE {needsyncTable} SET lastsync = datetime('2000-01-01') WHERE lastsync IS NULL")
             cur.execute(f"UPDATE {needsyncTable} SET kbmod = datetime('2000-01-01') WHERE kbmod IS NULL")
             cur.execute(f"UPDATE {needsyncTable} SET twmod = datetime('2000-01-01') WHERE twmod IS NULL")
-            tobesynced=cur.execute(f"select uuid,kbid,MAX(twmod) AS twmod,MAX(kbmod) AS kbmod,lastsync from {needsyncTable} WHERE twmod > lastsync OR kbmod > lastsync group by uuid,kbid").fetchall()
+            tobesynced=cur.execute(f"select uuid,kbid,MAX(twmod) AS twmod,MAX(kbmod) AS kbmod,lastsync,base,MAX(linked) AS linked from {needsyncTable} WHERE twmod > lastsync OR kbmod > lastsync group by uuid,kbid").fetchall()
 
         #commit the above sql operations
         self._dbcon.commit()
@@ -379,71 +897,165 @@ class DbConnector:
             print("no tasks need to be synced")
             #but do set the lastsync time to now
             # self._setlastSync(projconf['project'])
+            self._syncDone(projconf,lastevent,fullcheck)
             return
-        with self.newcur() as cur:
+        #updates of existing links are buffered and written in chunks (one transaction per chunk),
+        #together with the resulting state of the kanboard task in the mirror
+        mirror=self._mirrorBuffer(projconf)
+        links=LinkBuffer(self._dbcon,(f"INSERT OR REPLACE INTO {synctaskTable} (kbid,uuid,base,lastsync) VALUES(?,?,?,?)",self._mirrorSql(projconf)))
+        failure=None
+        try:
+            if not self._test:
+                #the search results carry the current state of the modified kanboard tasks
+                for kbtask in kbtasks.values():
+                    mirror.add(kbtask.astuple())
+                mirror.flush()
             for item in tobesynced:
-                kbid=item['kbid']
-                uuid=item['uuid']
-                
-                #try to retrieve the tasks
-                if kbid is not None:
-                    kbtask=next(iter([el for el in kbtasks if int(el['id']) == kbid ]), None)
-
-                    if kbtask is None:
-                        #try getting it from the server
-                        try:
-                            kbtask=kbclnt.getTask(task_id=kbid)
-                        except KBClientError:
-                            #note found or inaccessible
-                            logging.error(f"Taskwarrior task {uuid} cannot be found in kanboard anymore, try cleaning dangling entries with  tasksync.py --purge -v {projconf['project']}")
-                            #skip for now
-                            continue
-                else:
-                    kbtask=None
-
-                if uuid is not None:
-                    twtask=next(iter([el for el in twtasks if el['uuid'] == uuid ]),None)
-                    if twtask is None:
-                        twtask=twclnt.tasks.get(uuid=uuid)
-                else:
-                    twtask=None
-                
-                twmod=datetime.strptime(item['twmod'],'%Y-%m-%d %H:%M:%S')
-                kbmod=datetime.strptime(item['kbmod'],'%Y-%m-%d %H:%M:%S')
-                lastsync=item['lastsync']
-
-                #detect whether a conflict has arisen
-                if (kbmod > lastsync) and (twmod > lastsync):
-                    conflict=True
-                    logging.debug(f"Resolving conflict..")
-                else:
-                    conflict=False
-
-                #create a kanboard task from a taskwarrior task
-                if twtask is not None and twmod > lastsync:
-                    if kbtask is None:
-                        logging.debug(f"Creating new Kanboard task from Taskwarrior task {uuid}")
-                    else:
-                        logging.debug(f"Updating Kanboard task {kbid} from Taskwarrior task {uuid}")
+                try:
+                    synced=self._syncItem(item,kbclnt,twclnt,twreader,kbtasks,twtasks,projconf)
+                except (KBClientError,TWClientError,RuntimeError) as exc:
+                    #a failing task only loses its own link update
+                    logging.error(f"Failed to synchronize task (kbid={item['kbid']},uuid={item['uuid']}): {exc}")
+                    failure=exc
+                    continue
+                if synced is not None and not self._test:
+                    link,kbtask=synced
+                    links.add((link+(datetime.now(),),kbtask.astuple() if kbtask is not None else None))
+                    if not item['linked']:
+                        #new links are written right away, so a crash can't lead to duplicate tasks in the next sync
+                        links.flush()
+        finally:
+            links.flush()
 
-                    kbid,kbtask=kbFromtwTask(twtask,kbclient=kbclnt,projconf=projconf,kbtask=kbtask,conflict=conflict,test=self._test)
+        if failure is not None:
+            #don't advance the sync time of the project so failed tasks are retried
+            raise failure
 
-                if kbtask is not None and kbmod > lastsync:
-                    if twtask is None:
-                        logging.debug(f"Creating new Taskwarrior task from Kanboard task {kbid}")
-                    else:
-                        logging.debug(f"Updating Taskwarrior task {uuid} from Kanboard task {kbid}")
-                    uuid,twtask=twFromkbTask(kbtask,projconf=projconf,twtask=twtask,twclient=twclnt,test=self._test)
-                
-                if not self._test:
-                    cur.execute(f"INSERT OR REPLACE INTO {synctaskTable} (kbid,uuid,lastsync) VALUES(?,?,?)",(kbid,uuid,datetime.now())) 
-                    self._dbcon.commit()
-           
         #set overall sync of the database
         self._setlastSync(projconf['project'])
+        self._syncDone(projconf,lastevent,fullcheck)
 
+    def _writeLink(self,projconf,link):
+        """Immediately store a single (kbid,uuid,base,lastsync) link in its own transaction"""
+        if self._test:
+            return
+        with self._dbcon:
+            self._dbcon.execute(f"INSERT OR REPLACE INTO {projconf['synctable']} (kbid,uuid,base,lastsync) VALUES(?,?,?,?)",link)
+
+    def _syncDone(self,projconf,lastevent,fullcheck):
+        """Advance the change feed after a successful sync
+        Deletions don't show up in the feed, so a full check also reconciles the links against all tasks of the project
+        (purgeTasks confirms missing tasks one by one, so tasks which moved to another project only lose their link)"""
+        if fullcheck:
+            self.purgeTasks(projconf['project'])
+            self._setFeed(projconf['project'],lastevent,datetime.now())
+        else:
+            self._setFeed(projconf['project'],lastevent)
+
+    def _kbWrite(self,projconf,kbclnt,kbid,mirrored,write):
+        """Execute a write to a kanboard task (returning kbid,kbtask), returns None when a task which was read from the mirror turned out to be gone"""
+        try:
+            return write()
+        except (KBClientError,RuntimeError) as exc:
+            if not mirrored or (isinstance(exc,KBClientError) and isTransportError(exc)):
+                raise
+            #the mirrored state may be stale, e.g. because the task was deleted in kanboard
+            with self._dbcon:
+                self._dbcon.execute(f"DELETE FROM {projconf['mirrortable']} WHERE kbid = ?",(kbid,))
+            kbjson=self._kbLookup(kbclnt,kbid)
+            if kbjson is not None and int(kbjson['project_id']) == int(projconf['projid']):
+                #the task still exists, so this is a genuine failure
+                raise
+            logging.error(f"Kanboard task {kbid} does not exist in this project anymore, skipping it (try cleaning dangling entries with tasksync.py --purge -v {projconf['project']})")
+            return None
 
+    def _syncItem(self,item,kbclnt,twclnt,twreader,kbtasks,twtasks,projconf):
+        """Synchronize a single pair of tasks, returns the (kbid,uuid,base) link and the resulting kanboard snapshot or None when the task was skipped"""
+        kbid=item['kbid']
+        uuid=item['uuid']
         
+        #try to retrieve the tasks
+        mirrored=False
+        if kbid is not None:
+            kbtask=kbtasks.get(kbid)
 
+            if kbtask is None:
+                #the task was not modified since the last sync, so its mirrored state is still valid
+                kbtask=self._mirrorGet(projconf,kbid)
+                mirrored=kbtask is not None
 
+            if kbtask is None:
+                #try getting it from the server
+                try:
+                    kbtask=kbclnt.getTask(task_id=kbid)
+                    if not kbtask:
+                        raise KBClientError(f"Kanboard task {kbid} does not exist")
+                    kbtask=KBSnapshot.fromjson(kbtask)
+                except KBClientError:
+                    #note found or inaccessible
+                    logging.error(f"Taskwarrior task {uuid} cannot be found in kanboard anymore, try cleaning dangling entries with  tasksync.py --purge -v {projconf['project']}")
+                    #skip for now
+                    return None
+        else:
+            kbtask=None
+
+        if uuid is not None:
+            twtask=twtasks.get(uuid)
+            if twtask is None:
+                twtask=twreader.get(uuid)
+        else:
+            twtask=None
+        
+        twmod=datetime.strptime(item['twmod'],'%Y-%m-%d %H:%M:%S')
+        kbmod=datetime.strptime(item['kbmod'],'%Y-%m-%d %H:%M:%S')
+        lastsync=item['lastsync']
+
+        #last synced state of the mapped fields
+        base=json.loads(item['base']) if item['base'] else None
+
+        #detect whether a conflict has arisen
+        if (kbmod > lastsync) and (twmod > lastsync) and twtask is not None and kbtask is not None:
+            logging.debug(f"Merging changes of Kanboard task {kbid} and Taskwarrior task {uuid}")
+            twstate=stateFromtw(twtask,projconf)
+            kbstate=stateFromkb(kbtask,projconf)
+            twtarget,kbtarget,base,flagged=mergeStates(base,twstate,kbstate,self._conflictpolicy,twmod,kbmod)
+            if flagged:
+                logging.warning(f"Conflicting changes in {','.join(flagged)} of Kanboard task {kbid} and Taskwarrior task {uuid}, please resolve by hand")
+            if kbtarget != kbstate:
+                written=self._kbWrite(projconf,kbclnt,kbid,mirrored,lambda: kbFromState(kbtarget,kbclient=kbclnt,projconf=projconf,kbtask=kbtask,test=self._test))
+                if written is None:
+                    return None
+                kbid,kbtask=written
+            if twtarget != twstate or flagged or conflictTag in twtask.tags:
+                uuid,twtask=twFromState(twtarget,projconf=projconf,twtask=twtask,twclient=twclnt,test=self._test,flag=bool(flagged))
+            return (kbid,uuid,json.dumps(base)),kbtask
+
+        #create a kanboard task from a taskwarrior task
+        if twtask is not None and twmod > lastsync:
+            if kbtask is None:
+                logging.debug(f"Creating new Kanboard task from Taskwarrior task {uuid}")
+            else:
+                logging.debug(f"Updating Kanboard task {kbid} from Taskwarrior task {uuid}")
+
+            base=stateFromtw(twtask,projconf)
+            def created(newkbid):
+                #store the link as soon as the kanboard task exists (before moving/closing it)
+                self._writeLink(projconf,(newkbid,uuid,json.dumps(base),datetime.now()))
+            written=self._kbWrite(projconf,kbclnt,kbid,mirrored,lambda: kbFromtwTask(twtask,kbclient=kbclnt,projconf=projconf,kbtask=kbtask,test=self._test,oncreate=created))
+            if written is None:
+                return None
+            kbid,kbtask=written
+            if conflictTag in twtask.tags and not kbmod > lastsync:
+                #both sides agree again, so clear the conflict flag
+                uuid,twtask=twFromState(base,projconf=projconf,twtask=twtask,twclient=twclnt,test=self._test)
+
+        if kbtask is not None and kbmod > lastsync:
+            if twtask is None:
+                logging.debug(f"Creating new Taskwarrior task from Kanboard task {kbid}")
+            else:
+                logging.debug(f"Updating Taskwarrior task {uuid} from Kanboard task {kbid}")
+            base=stateFromkb(kbtask,projconf)
+            uuid,twtask=twFromkbTask(kbtask,projconf=projconf,twtask=twtask,twclient=twclnt,test=self._test)
+        
+        return (kbid,uuid,json.dumps(base)),kbtask
 
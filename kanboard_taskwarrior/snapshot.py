@@ -0,0 +1,192 @@
+# contains compact snapshots of kanboard and taskwarrior tasks
+# Only the fields which take part in the mapping are kept, so that large syncs don't need to hold
+# full tasklib Task objects or kanboard task dictionaries (which carry 40+ unused fields)
+
+import json
+from datetime import datetime,timezone
+from kanboard_taskwarrior.clients import TWDoesNotExist,TWClientError
+
+twDateFormat="%Y%m%dT%H%M%SZ"
+
+def twTimestamp(datestr):
+    """Convert a taskwarrior (UTC) export timestamp to a naive datetime in local time"""
+    if not datestr:
+        return None
+    return datetime.strptime(datestr,twDateFormat).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+def localNaive(dt):
+    """Convert a (possibly timezone aware) datetime to a naive datetime in local time"""
+    if dt is None:
+        return None
+    if dt.tzinfo is not None:
+        dt=dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+class KBSnapshot:
+    """Compact representation of a kanboard task, holding only the mapped fields"""
+    __slots__=("id","title","due","column","swimlane","category","owner","active","modified","position")
+
+    def __init__(self,id,title,due=0,column=0,swimlane=0,category=0,owner=0,active=True,modified=0,position=0):
+        self.id=id
+        self.title=title
+        #timestamps are kept as integers (0 means not set), as returned by the kanboard API
+        self.due=due
+        self.column=column
+        self.swimlane=swimlane
+        self.category=category
+        self.owner=owner
+        self.active=active
+        self.modified=modified
+        #position within the column (0 means unknown)
+        self.position=position
+
+    @classmethod
+    def fromjson(cls,kbtask):
+        """Create a snapshot from a task dictionary as returned by the kanboard JSON-RPC API"""
+        return cls(int(kbtask['id']),kbtask['title'],
+                due=int(kbtask['date_due'] or 0),
+                column=int(kbtask['column_id']),
+                swimlane=int(kbtask['swimlane_id']),
+                category=int(kbtask['category_id'] or 0),
+                owner=int(kbtask['owner_id'] or 0),
+                active=int(kbtask['is_active']) == 1,
+                modified=int(kbtask['date_modification']),
+                position=int(kbtask.get('position') or 0))
+
+    @classmethod
+    def fromrow(cls,row):
+        """Create a snapshot from a row of the local mirror table (see astuple)"""
+        return cls(row['kbid'],row['title'],due=row['date_due'],column=row['column_id'],swimlane=row['swimlane_id'],
+                category=row['category_id'],owner=row['owner_id'],active=bool(row['is_active']),modified=row['date_modification'],position=row['position'] or 0)
+
+    def astuple(self):
+        """Values in the order of the columns of the local mirror table"""
+        return (self.id,self.title,self.due,self.column,self.swimlane,self.category,self.owner,int(self.active),self.modified,self.position)
+
+    @property
+    def lastmod(self):
+        return datetime.fromtimestamp(self.modified)
+
+    def __repr__(self):
+        return f"KBSnapshot(id={self.id},title={self.title!r})"
+
+
+class TWSnapshot:
+    """Compact representation of a taskwarrior task, holding only the mapped fields"""
+    __slots__=("uuid","title","due","status","start","wait","swimlane","category","modified","tags")
+
+    def __init__(self,uuid,title,due=None,status="pending",start=None,wait=None,swimlane=None,category=None,modified=None,tags=()):
+        self.uuid=uuid
+        self.title=title
+        #dates are naive datetimes in local time
+        self.due=due
+        self.status=status
+        self.start=start
+        self.wait=wait
+        self.swimlane=swimlane
+        self.category=category
+        self.modified=modified
+        self.tags=tags
+
+    @classmethod
+    def fromjson(cls,twtask):
+        """Create a snapshot from a task dictionary as returned by task export"""
+        return cls(twtask['uuid'],twtask.get('description'),
+                due=twTimestamp(twtask.get('due')),
+                status=twtask.get('status'),
+                start=twTimestamp(twtask.get('start')),
+                wait=twTimestamp(twtask.get('wait')),
+                swimlane=twtask.get('swimlane'),
+                category=twtask.get('kbcat'),
+                modified=twTimestamp(twtask.get('modified')),
+                tags=tuple(twtask.get('tags',())))
+
+    @classmethod
+    def fromchampion(cls,uuid,data):
+        """Create a snapshot from the task data (property map) as stored in a taskwarrior 3 (taskchampion) replica"""
+        def epoch(ky):
+            return datetime.fromtimestamp(int(data[ky])) if data.get(ky) else None
+        return cls(uuid,data.get('description'),
+                due=epoch('due'),
+                status=data.get('status'),
+                start=epoch('start'),
+                wait=epoch('wait'),
+                swimlane=data.get('swimlane'),
+                category=data.get('kbcat'),
+                modified=epoch('modified'),
+                #tags are stored as tag_<name> properties
+                tags=tuple(ky[4:] for ky in data if ky.startswith('tag_')))
+
+    @classmethod
+    def fromtask(cls,task):
+        """Create a snapshot from a (full) tasklib Task"""
+        return cls(task['uuid'],task['description'],
+                due=localNaive(task['due']),
+                status=task['status'],
+                start=localNaive(task['start']),
+                wait=localNaive(task['wait']),
+                swimlane=task['swimlane'],
+                category=task['kbcat'],
+                modified=localNaive(task['modified']),
+                tags=tuple(task['tags'] or ()))
+
+    @property
+    def active(self):
+        return self.start is not None
+
+    @property
+    def waiting(self):
+        return self.wait is not None and self.wait > datetime.now()
+
+    @property
+    def completed(self):
+        return self.status == "completed"
+
+    @property
+    def deleted(self):
+        return self.status == "deleted"
+
+    @property
+    def recurring(self):
+        return self.status == "recurring"
+
+    def __repr__(self):
+        return f"TWSnapshot(uuid={self.uuid},title={self.title!r})"
+
+
+def twExport(twclnt,qset):
+    """Run the export of a tasklib queryset and directly convert the json output to snapshots (bypasses the creation of tasklib Tasks)"""
+    #generate pending instances of recurring tasks first (as tasklib does before filtering)
+    twclnt.enforce_recurrence()
+    args=qset.filter_obj.get_filter_params()+["export"]
+    snapshots=[]
+    for line in twclnt.execute_command(args):
+        data=line.strip(',')
+        if not data or data in ('[',']'):
+            continue
+        try:
+            snapshots.append(TWSnapshot.fromjson(json.loads(data)))
+        except ValueError:
+            raise TWClientError(f"Invalid JSON: {data}")
+    return snapshots
+
+def twGet(twclnt,uuid):
+    """Retrieve a snapshot of a single taskwarrior task"""
+    snapshots=twExport(twclnt,twclnt.tasks.filter(uuid=uuid))
+    if not snapshots:
+        raise TWDoesNotExist(f"Taskwarrior task {uuid} does not exist")
+    return snapshots[0]
+
+class TWExportReader:
+    """Reads taskwarrior snapshots through task export (see twstore.TWStore for a direct read path)"""
+    def __init__(self,twclnt):
+        self._twclnt=twclnt
+
+    def changedSince(self,project,since):
+        """Snapshots of the (non deleted and non recurring) tasks of a project modified after since"""
+        twqry=self._twclnt.tasks.filter(project=project,modified__after=since,status__not="Deleted").filter(status__not="Recurring")
+        return twExport(self._twclnt,twqry)
+
+    def get(self,uuid):
+        return twGet(self._twclnt,uuid)
@@ -7,6 +7,9 @@ from kanboard import ClientError
 from tasklib import Task
 from datetime import datetime,timedelta,date
 import logging
+import time
+from kanboard_taskwarrior.snapshot import KBSnapshot,TWSnapshot
+
 def getVtags():
 
     vtags=OrderedDict()
@@ -22,171 +25,304 @@ colkey="vtag.columns"
 catkey="uda.kbcat"
 swimkey="uda.swimlane"
 
-def twFromkbTask(kbtask,twclient,projconf,twtask=None,test=False):
-    #
+#fields of the (side independent) task state which are synchronized
+mappedFields=("title","due","vtag","swimlane","category")
+#ways to resolve fields which were changed differently on both sides
+conflictPolicies=("newest","kanboard","taskwarrior","flag")
+#taskwarrior tag which marks tasks with unresolved (flagged) conflicts
+conflictTag="kbconflict"
+
+def kbTimestamp(due):
+    """Convert a taskwarrior due date to a kanboard timestamp (kanboard only stores minutes, 0 means not set)"""
+    if due is None:
+        return 0
+    return int(due.replace(second=0,microsecond=0).timestamp())
+
+def twVtag(twtask,projconf):
+    """Determine the vtag (and hence the kanboard column) of a taskwarrior task"""
+    due=twtask.due
+    #default vtag is the first registered one
+    vtag=next(iter(projconf["mapping"][colkey]))
+    if twtask.active:
+        vtag='ACTIVE'
+    elif twtask.completed:
+        vtag='COMPLETED'
+    elif twtask.waiting:
+        vtag='WAITING'
+    elif 'WEEK' in projconf["mapping"][colkey] and due is not None:
+        year, due_week, day_of_week = due.isocalendar()
+
+        year, current_week, day_of_week = datetime.now().isocalendar()
+
+
+        if due_week == current_week:
+            vtag='WEEK'
+
+    elif 'TOMORROW' in projconf["mapping"][colkey] and due is not None:
+        tomorrow=date.today()+timedelta(days=1)
+        if tomorrow == due.date():
+            vtag="TOMORROW"
+    else:
+       #Trigger the default column
+       vtag="NONE"
+    return vtag
+
+def stateFromtw(twtask,projconf):
+    """Returns the mapped state of a taskwarrior task (TWSnapshot)"""
+    return {"title":twtask.title,"due":kbTimestamp(twtask.due),"vtag":twVtag(twtask,projconf),"swimlane":twtask.swimlane,"category":twtask.category}
+
+def stateFromkb(kbtask,projconf):
+    """Returns the mapped state of a kanboard task (KBSnapshot)"""
+    mapping=projconf["mapping"]
+    vtag=next(iter([ky for ky,val in mapping[colkey].items() if int(val['kbid']) == kbtask.column]),"NONE")
+    swimlane=next(iter([ky for ky,val in mapping[swimkey].items() if int(val['kbid']) == kbtask.swimlane]),None)
+    cat=next(iter([ky for ky,val in mapping[catkey].items() if int(val['kbid']) == kbtask.category]),None)
+    return {"title":kbtask.title,"due":kbtask.due,"vtag":vtag,"swimlane":swimlane,"category":cat}
+
+def mergeStates(base,twstate,kbstate,policy="newest",twmod=None,kbmod=None):
+    """Three-way merge of the taskwarrior and kanboard states with respect to the last synced (base) state
+    Fields which changed on one side only are merged automatically, fields which changed differently on both sides are resolved by the policy:
+    newest: take the value of the most recently modified side
+    kanboard/taskwarrior: take the value of that side
+    flag: leave both sides untouched and flag the conflict (it is reported again until both sides agree)
+    Returns the target taskwarrior state, target kanboard state, the new base state and a list of flagged fields"""
+    if policy not in conflictPolicies:
+        raise ValueError(f"Unknown conflict policy {policy}")
+    twtarget={}
+    kbtarget={}
+    newbase={}
+    flagged=[]
+    for ky in mappedFields:
+        twval=twstate[ky]
+        kbval=kbstate[ky]
+        if twval == kbval:
+            merged=twval
+        elif base is not None and twval == base.get(ky):
+            #changed on the kanboard side only
+            merged=kbval
+        elif base is not None and kbval == base.get(ky):
+            #changed on the taskwarrior side only
+            merged=twval
+        elif policy == "flag":
+            twtarget[ky]=twval
+            kbtarget[ky]=kbval
+            #no common base anymore, so the field keeps conflicting until resolved
+            newbase[ky]=None
+            flagged.append(ky)
+            continue
+        elif policy == "kanboard" or (policy == "newest" and (twmod is None or kbmod is None or kbmod >= twmod)):
+            merged=kbval
+        else:
+            merged=twval
+        twtarget[ky]=merged
+        kbtarget[ky]=merged
+        newbase[ky]=merged
+
+    return twtarget,kbtarget,newbase,flagged
+
+
+def twNeedsUpdate(state,twtask):
+    """Check whether an existing taskwarrior task (TWSnapshot) differs from the mapped state"""
+    if conflictTag in twtask.tags:
+        #the conflict flag needs to be cleared
+        return True
+    if state['title'] != twtask.title:
+        return True
+    if state['due'] != 0 and state['due'] != kbTimestamp(twtask.due):
+        return True
+    vtag=state['vtag']
+    if vtag == 'WAITING' and (twtask.active or not twtask.waiting):
+        return True
+    if vtag == 'ACTIVE' and not twtask.active and not twtask.completed:
+        return True
+    if vtag == 'COMPLETED' and not twtask.completed and not twtask.deleted:
+        return True
+    if vtag == 'WEEK' and twtask.waiting:
+        return True
+    if state['swimlane'] is not None and state['swimlane'] != twtask.swimlane:
+        return True
+    if state['category'] is not None and state['category'] != twtask.category:
+        return True
+    return False
+
+def twFromState(state,twclient,projconf,twtask=None,test=False,flag=False):
+    """Create or update a taskwarrior task so it reflects the mapped state (twtask is a TWSnapshot or None)
+    Existing tasks which already reflect the state are left untouched"""
+    if twtask is not None and not flag and not twNeedsUpdate(state,twtask):
+        return twtask.uuid,twtask
+
     if twtask is None:
         #create a new taskwarrior task
-        twtask=Task(twclient,description=kbtask['title'])
+        task=Task(twclient,description=state['title'])
     else:
-        #update an existing one
-        twtask['description']=kbtask['title']
-    
-    twtask['project']=projconf['project']
+        #load the full task only now that it needs to be written
+        task=twclient.tasks.get(uuid=twtask.uuid)
+        task['description']=state['title']
+
+    task['project']=projconf['project']
     # add additional properties
-    datedue=int(kbtask['date_due'])
-    if datedue != 0:
-        twtask['due']=datetime.fromtimestamp(datedue)
+    datedue=state['due']
+    #kanboard only stores minutes, so don't overwrite due dates which only differ in seconds
+    if datedue != 0 and (twtask is None or datedue != kbTimestamp(twtask.due)):
+        task['due']=datetime.fromtimestamp(datedue)
 
-    vtag=next(iter([ky for ky,val in projconf["mapping"]['vtag.columns'].items() if int(val['kbid']) == kbtask['column_id']]),"NONE")
+    vtag=state['vtag']
     if vtag == 'WAITING':
-        if twtask.active:
+        if task.active:
             #stop the task if it's active
-            twtask.stop()
-        #set wait date a year from now
-        twtask['wait']=datetime.now()+timedelta(days=366)
-        twtask.save()
+            task.stop()
+        if not task.waiting:
+            #set wait date a year from now
+            task['wait']=datetime.now()+timedelta(days=366)
+            task.save()
     elif vtag == 'ACTIVE':
-        if not test and not twtask.active and not twtask.completed:
-            twtask.save()
+        if not test and not task.active and not task.completed:
+            task.save()
             #also unset the waiting date if it has one so it will become visible
-            if twtask.waiting:
-                twtask['wait']=None
-            twtask.start()
-            twtask.save()
+            if task.waiting:
+                task['wait']=None
+            task.start()
+            task.save()
     elif vtag == 'COMPLETED':
-        if not test and not twtask.completed and not twtask.deleted:
-            twtask.save()
-            twtask.done()
+        if not test and not task.completed and not task.deleted:
+            task.save()
+            task.done()
     elif vtag == 'WEEK':
-        if twtask.waiting:
+        if task.waiting:
             #unset waiting state
-            twtask['wait']=None
-            twtask.save()
+            task['wait']=None
+            task.save()
 
     #swimlane mapping
-    
-    swimlane=next(iter([ky for ky,val in projconf["mapping"]['uda.swimlane'].items() if int(val['kbid']) == kbtask['swimlane_id']]))
-    twtask['swimlane']=swimlane
+    if state['swimlane'] is not None:
+        task['swimlane']=state['swimlane']
+
+    if state['category'] is not None:
+        task['kbcat']=state['category']
+
+    if flag:
+        #mark the task so the conflicting fields can be resolved by hand
+        task['tags']=set(task['tags'] or [])|{conflictTag}
+    elif twtask is not None and conflictTag in twtask.tags:
+        #no field is in conflict anymore
+        task['tags']=set(task['tags'] or [])-{conflictTag}
 
-    cat=next(iter([ky for ky,val in projconf["mapping"]['uda.kbcat'].items() if int(val['kbid']) == kbtask['category_id']]),None)
-    if cat is not None:
-        twtask['kbcat']=cat
-    
     if not test:
-        twtask.save()
-        uuid=twtask['uuid']
+        task.save()
+        uuid=task['uuid']
     else:
         uuid="testinguuid"
 
-    return uuid,twtask
+    return uuid,TWSnapshot.fromtask(task)
 
-def kbFromtwTask(twtask,kbclient,projconf,kbtask=None,conflict=False,test=False):
+def twFromkbTask(kbtask,twclient,projconf,twtask=None,test=False):
+    #note: kbtask is a KBSnapshot and twtask is a TWSnapshot (or None)
+    return twFromState(stateFromkb(kbtask,projconf),twclient,projconf,twtask=twtask,test=test)
+
+def kbFromState(state,kbclient,projconf,kbtask=None,test=False,oncreate=None):
+    """Create or update a kanboard task so it reflects the mapped state (kbtask is a KBSnapshot or None)
+    oncreate(kbid) is called as soon as a new kanboard task has been created"""
     kbMutation={}
-    
-    kbMutation['title']=twtask['description']
+
+    kbMutation['title']=state['title']
 
     kbMutation['project_id']=projconf['projid']
-    
-    due=twtask['due']
-    if due is not None:
-        kbMutation['date_due']=due.strftime("%Y-%m-%d %H:%M")
+
+    due=state['due']
+    if due != 0:
+        kbMutation['date_due']=datetime.fromtimestamp(due).strftime("%Y-%m-%d %H:%M")
 
     #possibly add assignee
     if projconf['assignee']:
         kbMutation['owner_id']=projconf['assignee']['kbid']
     #determine the correct column to put the task in based on the mapped vtags
-    #default vtag is the first registered one
-    vtag=next(iter(projconf["mapping"]['vtag.columns']))
-    openTask=False
-    closeTask=False
-    if twtask.active:
-        vtag='ACTIVE'
-        openTask=True
-    elif twtask.completed:
-        vtag='COMPLETED'
-        closeTask=True
-    elif twtask.waiting:
-        vtag='WAITING'
-    elif 'WEEK' in projconf["mapping"]['vtag.columns'] and due is not None:
-        year, due_week, day_of_week = due.isocalendar()
-
-        year, current_week, day_of_week = datetime.now().isocalendar()
-
-
-        if due_week == current_week:
-            vtag='WEEK'
-
-    elif 'TOMORROW' in projconf["mapping"]['vtag.columns'] and due is not None:
-        tomorrow=date.today()+timedelta(days=1)
-        if tomorrow == due.date():
-            vtag="TOMORROW"
-    else:
-       #Trigger the default column
-       vtag="NONE"
+    vtag=state['vtag']
+    openTask=vtag == 'ACTIVE'
+    closeTask=vtag == 'COMPLETED'
 
-    if vtag != "NONE": 
-        kbMutation['column_id']=int(next(iter([val['kbid'] for ky,val in projconf["mapping"]['vtag.columns'].items() if ky == vtag])))
+    if vtag in projconf["mapping"][colkey]:
+        kbMutation['column_id']=int(projconf["mapping"][colkey][vtag]['kbid'])
 
     #determine the correct swimlane (or default)
 
-    swimlane=twtask['swimlane']
+    swimlane=state['swimlane']
 
-    if swimlane in projconf["mapping"]["uda.swimlane"]:
-        # import pdb;pdb.set_trace()
-        kbMutation['swimlane_id']=int(projconf["mapping"]['uda.swimlane'][swimlane]['kbid'])
+    if swimlane in projconf["mapping"][swimkey]:
+        kbMutation['swimlane_id']=int(projconf["mapping"][swimkey][swimlane]['kbid'])
 
     #determine the correct category (or None)
-    cat=twtask['kbcat']
+    cat=state['category']
 
     if cat is not None:
         try:
-            kbMutation['category_id']=int(next(iter([val['kbid'] for ky,val in projconf["mapping"]['uda.kbcat'].items() if ky == cat ])))
+            kbMutation['category_id']=int(next(iter([val['kbid'] for ky,val in projconf["mapping"][catkey].items() if ky == cat ])))
         except StopIteration:
             logging.warning(f"Taskwarrior category {cat} not found in mapping, ignoring")
-            
-    if not test:
-        if kbtask and conflict:
-            # duplicate the existing task and mark as a conflict
-            kbidconflict=kbclient.duplicateTaskToProject(task_id=kbtask['id'],project_id=projconf['projid'])
-            if not kbidconflict:
-                raise RuntimeError("Did not succeed to create a duplicate kanboard task")
-            success=kbclient.updateTask(id=kbidconflict,title="CONFLICT"+kbtask['title'])
-
-            if not success:
-                raise RuntimeError("Did not succeed to update conflicted kanboard task")
 
+    if not test:
         if kbtask is None:
             #create a new kanboard task
             kbid=kbclient.createTask(**kbMutation)
             if not kbid:
                 raise RuntimeError("Did not succeed to create kanboard task")
+            if oncreate is not None:
+                oncreate(kbid)
+            #retrieve the newly created task from the server (e.g. default column and swimlane are set by the server)
+            kbtask=KBSnapshot.fromjson(kbclient.getTask(task_id=kbid))
         else:
-            kbid=int(kbtask['id'])
-            updateMutation={ky:kbMutation[ky] for ky in ("title","category_id","date_due") if ky in kbMutation}
-            updateMutation["id"]=kbid
-            success=kbclient.updateTask(**updateMutation)
-            if not success:
-                raise RuntimeError("Did not succeed to update kanboard task")
-            
-            if "column_id" in kbMutation or "swimlane_id" in kbMutation:
+            kbid=kbtask.id
+            #only send the fields which actually change (every call touches the modification date of the task)
+            updateMutation={}
+            if kbMutation['title'] != kbtask.title:
+                updateMutation['title']=kbMutation['title']
+            if 'category_id' in kbMutation and kbMutation['category_id'] != kbtask.category:
+                updateMutation['category_id']=kbMutation['category_id']
+            if due != 0 and due != kbtask.due:
+                updateMutation['date_due']=kbMutation['date_due']
+
+            #no need to retrieve the updated task again: the new state follows from the mutation
+            kbtask=KBSnapshot(kbid,updateMutation.get('title',kbtask.title),due=due if 'date_due' in updateMutation else kbtask.due,column=kbtask.column,swimlane=kbtask.swimlane,
+                    category=updateMutation.get('category_id',kbtask.category),owner=kbtask.owner,active=kbtask.active,modified=kbtask.modified,position=kbtask.position)
+
+            if updateMutation:
+                updateMutation["id"]=kbid
+                success=kbclient.updateTask(**updateMutation)
+                if not success:
+                    raise RuntimeError("Did not succeed to update kanboard task")
+                kbtask.modified=int(time.time())
+
+            #only move when the column or swimlane changes
+            newcolumn=kbMutation.get("column_id",kbtask.column) != kbtask.column
+            if newcolumn or kbMutation.get("swimlane_id",kbtask.swimlane) != kbtask.swimlane:
 
                 moveMutation={ky:int(kbMutation[ky]) for ky in ("column_id","swimlane_id","project_id") if ky in kbMutation}
-                moveMutation["task_id"]=kbid#note the kanboard movetaskPosition call expects the task id not as id but as task_id 
-                moveMutation["position"]=1 #put at the top 
+                moveMutation["task_id"]=kbid#note the kanboard movetaskPosition call expects the task id not as id but as task_id
+                #put at the top of a new column, but keep the manual order within the same column
+                moveMutation["position"]=1 if newcolumn or not kbtask.position else kbtask.position
                 try:
                     success=kbclient.moveTaskPosition(**moveMutation)
+                    if success:
+                        kbtask.column=moveMutation.get("column_id",kbtask.column)
+                        kbtask.swimlane=moveMutation.get("swimlane_id",kbtask.swimlane)
+                        kbtask.position=moveMutation["position"]
+                        kbtask.modified=int(time.time())
                 except ClientError:
                     logging.warning("Did not succeed to move kanboard task, no change in position?")
-        if kbid:
-            #reretrieve newly generated or updated task from server
-            kbtask=kbclient.getTask(task_id=kbid)
-        
-        if closeTask and kbid:
+
+        if closeTask and kbid and kbtask.active:
             kbclient.closeTask(task_id=kbid)
-        if openTask and kbid:
+            kbtask.active=False
+            kbtask.modified=int(time.time())
+        if openTask and kbid and not kbtask.active:
             kbclient.openTask(task_id=kbid)
+            kbtask.active=True
+            kbtask.modified=int(time.time())
     else:
         kbid=-1#testng purposes only
 
-    
+
     return kbid,kbtask
+
+def kbFromtwTask(twtask,kbclient,projconf,kbtask=None,test=False,oncreate=None):
+    #note: twtask is a TWSnapshot and kbtask is a KBSnapshot (or None)
+    return kbFromState(stateFromtw(twtask,projconf),kbclient,projconf,kbtask=kbtask,test=test,oncreate=oncreate)
@@ -0,0 +1,169 @@
+# contains the transport policy which is applied to all calls to a kanboard server:
+# an adaptive token bucket rate limit, retries with backoff for idempotent reads and a circuit breaker
+
+import time
+import random
+import logging
+from urllib.parse import urlsplit
+from kanboard import ClientError
+
+class CircuitOpen(ClientError):
+    """Raised when calls to a kanboard server are fast-failed because the server is considered to be down"""
+    pass
+
+def isTransportError(exc):
+    """Distinguish network/server failures from regular API errors (the kanboard client chains the cause of the former)
+    Calls which were not made because the circuit is open count as transport errors as well"""
+    return isinstance(exc,CircuitOpen) or exc.__cause__ is not None
+
+def isIdempotent(method):
+    """Whether a kanboard API method only reads (and can be safely retried)"""
+    return method.startswith(("get","search"))
+
+class TransportPolicy:
+    """Transport policy of a single kanboard server
+    The request rate adapts to the server: it increases additively while calls are fast and succeed,
+    and decreases multiplicatively on slow calls and failures (AIMD).
+    After failthreshold consecutive transport failures the circuit opens and calls fail fast for cooldown seconds,
+    after which a single probe call is let through (half-open) to decide whether to close the circuit again"""
+    def __init__(self,rate=5.0,minrate=0.2,maxrate=50.0,burst=5,retries=3,backoff=0.5,failthreshold=5,cooldown=60,slowcall=2.0):
+        self.rate=rate
+        self.minrate=minrate
+        self.maxrate=maxrate
+        self.burst=burst
+        self.retries=retries
+        self.backoff=backoff
+        self.failthreshold=failthreshold
+        self.cooldown=cooldown
+        self.slowcall=slowcall
+        self._tokens=burst
+        self._lastfill=time.monotonic()
+        self._nfail=0
+        self._openuntil=None
+        self._probing=False
+        #statistics
+        self.ncalls=0
+        self.nerrors=0
+        self.nretries=0
+        self.latency=0.0
+        #(monotonic) time of the last call which reached the server
+        self.lastsuccess=None
+
+    @property
+    def state(self):
+        if self._openuntil is None:
+            return "closed"
+        if time.monotonic() < self._openuntil:
+            return "open"
+        return "half-open"
+
+    def available(self):
+        """Whether calls may currently be made to the server"""
+        state=self.state
+        if state == "open":
+            return False
+        if state == "half-open":
+            #only a single probe is allowed
+            return not self._probing
+        return True
+
+    def _acquire(self):
+        """Wait for a token of the bucket"""
+        while True:
+            now=time.monotonic()
+            self._tokens=min(self.burst,self._tokens+(now-self._lastfill)*self.rate)
+            self._lastfill=now
+            if self._tokens >= 1:
+                self._tokens-=1
+                return
+            time.sleep((1-self._tokens)/self.rate)
+
+    def success(self,elapsed):
+        self._nfail=0
+        self.lastsuccess=time.monotonic()
+        if self._openuntil is not None:
+            logging.info("Kanboard server is reachable again, closing circuit")
+        self._openuntil=None
+        self._probing=False
+        #exponential moving average of the latency
+        self.latency=elapsed if self.latency == 0.0 else 0.8*self.latency+0.2*elapsed
+        if elapsed > self.slowcall:
+            self.rate=max(self.minrate,self.rate*0.8)
+        else:
+            self.rate=min(self.maxrate,self.rate+0.5)
+
+    def failure(self):
+        self.nerrors+=1
+        self._nfail+=1
+        self.rate=max(self.minrate,self.rate/2)
+        if self._probing or self._nfail >= self.failthreshold:
+            if self._openuntil is None or self._probing:
+                logging.warning(f"Kanboard server seems to be down, failing calls for the coming {self.cooldown} seconds")
+            self._openuntil=time.monotonic()+self.cooldown
+        self._probing=False
+
+    def execute(self,method,func):
+        """Execute a call (func) to the kanboard API method, according to the policy"""
+        ntries=1+(self.retries if isIdempotent(method) else 0)
+        try:
+            return self._execute(method,func,ntries)
+        finally:
+            #don't block the half-open circuit forever when the probe raised something unexpected
+            self._probing=False
+
+    def _execute(self,method,func,ntries):
+        for itry in range(ntries):
+            if not self.available():
+                raise CircuitOpen(f"Circuit open, not calling {method}")
+            if self.state == "half-open":
+                self._probing=True
+            self._acquire()
+            self.ncalls+=1
+            t0=time.monotonic()
+            try:
+                result=func()
+            except ClientError as exc:
+                if not isTransportError(exc):
+                    #a regular API error says nothing about the health of the server
+                    self.success(time.monotonic()-t0)
+                    raise
+                self.failure()
+                if itry+1 == ntries or not self.available():
+                    raise
+                self.nretries+=1
+                wait=self.backoff*2**itry*(1+random.random())
+                logging.debug(f"Call {method} failed ({exc}), retrying in {wait:.1f} seconds")
+                time.sleep(wait)
+                continue
+            self.success(time.monotonic()-t0)
+            return result
+
+    def stats(self):
+        return {"state":self.state,"rate":round(self.rate,2),"latency":round(self.latency,3),"calls":self.ncalls,"errors":self.nerrors,"retries":self.nretries}
+
+
+class PolicyClient:
+    """Wraps a kanboard client so that all calls go through the transport policy of its server"""
+    def __init__(self,client,policy):
+        self._client=client
+        self.policy=policy
+
+    def __getattr__(self,name):
+        method=getattr(self._client,name)
+        def function(*args,**kwargs):
+            return self.policy.execute(name,lambda: method(*args,**kwargs))
+        return function
+
+
+#policies are shared by all clients which connect to the same server
+_policies={}
+
+def getPolicy(url):
+    """Returns the transport policy of the server hosting url"""
+    key=urlsplit(url).netloc or url
+    if key not in _policies:
+        _policies[key]=TransportPolicy()
+    return _policies[key]
+
+def policyStats():
+    return {ky:policy.stats() for ky,policy in _policies.items()}
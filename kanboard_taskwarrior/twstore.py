@@ -0,0 +1,71 @@
+# contains a direct, read-only reader of the taskwarrior 3 (taskchampion) sqlite replica
+# It answers the queries of the sync with sql instead of spawning task export subprocesses, writes still go through task
+
+import os
+import json
+import sqlite3
+import logging
+from kanboard_taskwarrior.snapshot import TWSnapshot
+from kanboard_taskwarrior.clients import TWDoesNotExist
+
+replicaName="taskchampion.sqlite3"
+
+class TWStore:
+    """Read-only access to the tasks of a taskwarrior 3 replica
+    Query results are cached until the database (or its write ahead log) is modified"""
+    def __init__(self,path):
+        self.path=path
+        self._cache={}
+        self._stamp=None
+        self._conn=None
+
+    @classmethod
+    def fromClient(cls,twclnt,datadir=None):
+        """Returns a store for the data directory of a taskwarrior instance (or None when there is no taskwarrior 3 replica)"""
+        if datadir is None:
+            datadir=twclnt.overrides.get('data.location') or twclnt.config.get('data.location','~/.task')
+        path=os.path.join(os.path.expanduser(datadir),replicaName)
+        if not os.path.exists(path):
+            logging.warning(f"No taskwarrior 3 database found at {path}, falling back to task export")
+            return None
+        return cls(path)
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn=sqlite3.connect(f"file:{self.path}?mode=ro",uri=True)
+        return self._conn
+
+    def _filestamp(self):
+        stamp=[]
+        for fname in (self.path,self.path+"-wal"):
+            if os.path.exists(fname):
+                st=os.stat(fname)
+                stamp.append((st.st_mtime_ns,st.st_size))
+        return tuple(stamp)
+
+    def _query(self,sql,params=()):
+        stamp=self._filestamp()
+        if stamp != self._stamp:
+            #database changed since the last query
+            self._cache={}
+            self._stamp=stamp
+        key=(sql,params)
+        if key not in self._cache:
+            self._cache[key]=[TWSnapshot.fromchampion(uuid,json.loads(data)) for uuid,data in self._connect().execute(sql,params)]
+        return self._cache[key]
+
+    def changedSince(self,project,since):
+        """Snapshots of the (non deleted and non recurring) tasks of a project (including subprojects) modified after since"""
+        sql="""SELECT uuid,data FROM tasks
+            WHERE (json_extract(data,'$.project') = ? OR json_extract(data,'$.project') LIKE ? ESCAPE '\\')
+            AND CAST(json_extract(data,'$.modified') AS INTEGER) > ?
+            AND json_extract(data,'$.status') NOT IN ('deleted','recurring')"""
+        subprojects=project.replace('\\','\\\\').replace('%','\\%').replace('_','\\_')+".%"
+        return self._query(sql,(project,subprojects,int(since.timestamp())))
+
+    def get(self,uuid):
+        #note: uuid is the primary key of the tasks table
+        snapshots=self._query("SELECT uuid,data FROM tasks WHERE uuid = ?",(uuid,))
+        if not snapshots:
+            raise TWDoesNotExist(f"Taskwarrior task {uuid} does not exist")
+        return snapshots[0]
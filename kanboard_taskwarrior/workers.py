@@ -0,0 +1,100 @@
+# contains functionality to spread the synchronization of projects over multiple worker processes
+# Workers coordinate through a lease table in the sync database: each worker syncs only the projects it holds a lease on,
+# renews its leases with a heartbeat and takes over the projects of workers whose leases expired (e.g. after a crash)
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import multiprocessing
+from kanboard_taskwarrior.db import DbConnector,maintenanceLease
+
+def heartbeat(dbpath,worker,ttl,stop,claimed):
+    """Periodically renew the leases of a worker and claim expired leases (runs in a separate thread with its own database connection)
+    Sets the claimed event when the worker obtained new projects or when workers came or went, so the main loop syncs
+    the new projects and rebalances without waiting for the next cycle (surplus projects are only released by the main loop, in between syncs)"""
+    conn=DbConnector(dbpath=dbpath)
+    held=set()
+    nworkers=None
+    while not stop.wait(ttl/3):
+        try:
+            projects=set(conn.claimProjects(worker,ttl,release=False))
+            live=conn.liveWorkers()
+        except Exception as exc:
+            logging.error(f"Worker {worker} could not renew its leases: {exc}")
+            continue
+        if projects-held:
+            logging.info(f"Worker {worker} took over {sorted(projects-held)}")
+            claimed.set()
+        if nworkers is not None and live != nworkers:
+            claimed.set()
+        held=projects
+        nworkers=live
+
+def workerLoop(dbpath,interval,ttl=300,test=False,archivedays=None,conflictpolicy="newest",twdirect=False):
+    """Main loop of a single worker process"""
+    worker=f"{socket.gethostname()}-{os.getpid()}"
+    conn=DbConnector(dbpath=dbpath,test=test,conflictpolicy=conflictpolicy,twdirect=twdirect)
+    stop=threading.Event()
+    claimed=threading.Event()
+    beat=threading.Thread(target=heartbeat,args=(dbpath,worker,ttl,stop,claimed),daemon=True)
+    beat.start()
+    try:
+        while True:
+            claimed.clear()
+            conn.reload()
+            try:
+                #no project is being synced here, so surplus projects can be released safely
+                projects=conn.claimProjects(worker,ttl)
+            except sqlite3.OperationalError as exc:
+                logging.error(f"Worker {worker} could not claim projects, retrying at the next run: {exc}")
+                projects=[]
+            logging.info(f"Worker {worker} holds leases on {projects}")
+            for project in projects:
+                if not conn.holdsLease(worker,project):
+                    #lease was lost in the meantime (e.g. because of a stalled worker)
+                    continue
+                try:
+                    conn.syncTasks(project)
+                except Exception as exc:
+                    #ok try again next time (a failing project must not stop the worker)
+                    logging.error(f"Worker {worker} failed to synchronize {project}: {exc!r}")
+            if archivedays is not None:
+                try:
+                    #only one worker at a time maintains the database
+                    if conn.claimMaintenance(worker,ttl):
+                        try:
+                            conn.maintenance(archivedays)
+                        finally:
+                            conn.releaseLease(worker,maintenanceLease)
+                except sqlite3.OperationalError as exc:
+                    logging.error(f"Worker {worker} could not maintain the database, retrying at the next run: {exc}")
+            #wake up early when projects of other workers were taken over
+            claimed.wait(interval)
+    finally:
+        stop.set()
+        conn.releaseLeases(worker)
+
+def runWorkers(dbpath,nworkers,interval,ttl=300,test=False,archivedays=None,conflictpolicy="newest",twdirect=False):
+    """Start a pool of nworkers worker processes and restart workers which die"""
+    def start(iworker):
+        proc=multiprocessing.Process(target=workerLoop,args=(dbpath,interval,ttl,test,archivedays,conflictpolicy,twdirect),daemon=True)
+        proc.start()
+        return proc
+
+    procs=[start(i) for i in range(nworkers)]
+    try:
+        while True:
+            time.sleep(5)
+            for i,proc in enumerate(procs):
+                if not proc.is_alive():
+                    #its projects will be taken over once the leases expire
+                    logging.warning(f"Worker process {proc.pid} died (exitcode {proc.exitcode}), restarting")
+                    procs[i]=start(i)
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+        sys.exit(0)
@@ -2,14 +2,52 @@
 # Author R.Rietbroek, Aug 2022
 
 import sys
-from kanboard_taskwarrior.db import DbConnector
-from kanboard_taskwarrior.clients import TWClientError,KBClientError
+import os
+import socket
+from kanboard_taskwarrior.db import DbConnector,dbPath
+from kanboard_taskwarrior.daemon import runDaemon,loadProfiles
+from kanboard_taskwarrior.workers import runWorkers
+from kanboard_taskwarrior.taskmap import conflictPolicies
+from kanboard_taskwarrior.cassette import Cassette
+from kanboard_taskwarrior.clients import useCassette
+from kanboard_taskwarrior.control import ControlServer,sendCommand,socketPath
+import atexit
 import argparse
 import logging
 from pprint import pprint
-import time
 
 
+def reportCassette(cassette,maxrpcs=None):
+    """Store a recorded cassette and report (and check) the number of issued calls"""
+    cassette.save()
+    print(f"Issued calls: {cassette.summary()}")
+    nrpcs=cassette.ncalls("kb")
+    if maxrpcs is not None and nrpcs > maxrpcs:
+        logging.error(f"{nrpcs} Kanboard calls were issued, expected at most {maxrpcs}")
+        #note: sys.exit has no effect in exit handlers
+        os._exit(1)
+
+def printStatus(summary):
+    for projname,stat in summary.items():
+        print(f"Project: {projname} found at {stat['url']}, last synchronized {stat['lastsync']}")
+        print(f" {stat['links']} linked tasks ({stat['open']} open and {stat['closed']} closed in Kanboard mirror), {stat['archived']} archived links")
+
+def forwardCommand(path,command,project):
+    """Forward a command to a running daemon, returns False when no daemon is running"""
+    reply=sendCommand(path,{"command":command,"project":project})
+    if reply is None:
+        return False
+    logging.info(f"Executed {command} in the running daemon")
+    print(reply["output"],end="")
+    if not reply["ok"]:
+        logging.error(reply["error"])
+        sys.exit(1)
+    if command == "status":
+        printStatus(reply["result"])
+    elif command == "metrics":
+        pprint(reply["result"])
+    return True
+
 def main(argv):
 
     #parse command line arguments
@@ -23,6 +61,9 @@ def main(argv):
     parser.add_argument('-c','--config',action='store_true',
                         help="Configure/modify kanboard-taskwarrior connections")
 
+    parser.add_argument('--apply-config',type=str,metavar="FILE",default=None,
+                        help="Register or update the project links described in a json/toml file without prompting (see README)")
+
     parser.add_argument('-s','--sync',action='store_true',
                         help="Synchronize the registered connections")
 
@@ -39,11 +80,38 @@ def main(argv):
     parser.add_argument('-p','--purge',action='store_true',
                         help="Purge dangling tasks (deleted in either taskwarrior or kanboard)")
 
+    parser.add_argument('-a','--archive',action='store',nargs="?",metavar="DAYS",type=int,const=30,
+                        help="Archive links of tasks which are completed/closed on both sides for more than DAYS (default 30) and optimize the database (daily in daemon mode)")
+
     parser.add_argument('-l','--list',action='store_true',
                         help="List configured couplings")
+    parser.add_argument('--status',action='store_true',
+                        help="Show the number of synced, archived and mirrored tasks of the configured couplings (from the local database only)")
+    parser.add_argument('--metrics',action='store_true',
+                        help="Show the transport metrics (calls, errors, latency and state per Kanboard server) of the running daemon")
+    parser.add_argument('--control-socket',type=str,metavar="PATH",default=None,
+                        help="Control socket of the daemon (default is next to the sync database). Sync, purge, status and metrics commands are forwarded to a running daemon")
+    parser.add_argument('--no-daemon',action='store_true',
+                        help="Always run commands in this process, even when a daemon is running")
     
     parser.add_argument('--db-path',type=str, nargs="?",default=None,const=None,
                         help="Explicitly specify the database file to be used (default uses ~/.task/taskw-sync-KB.sql)")
+    parser.add_argument('--conflict-policy',choices=conflictPolicies,default="newest",
+                        help="How to resolve fields which were changed differently in Kanboard and Taskwarrior (default: take the newest change)")
+    parser.add_argument('--tw-direct',action='store_true',
+                        help="Read Taskwarrior state directly (read-only) from the Taskwarrior 3 database instead of running task export")
+    parser.add_argument('-w','--workers',type=int,metavar="N",default=None,
+                        help="Spread the projects over N worker processes in daemon mode (coordinated through leases in the database)")
+    parser.add_argument('--profiles',type=str,metavar="FILE",default=None,
+                        help="Serve multiple taskwarrior profiles (taskrc, data directory and sync database) listed in a json registry file from a single daemon")
+    parser.add_argument('--record',type=str,metavar="CASSETTE",default=None,
+                        help="Record all Kanboard calls and Taskwarrior commands (with timings) to a cassette file")
+    parser.add_argument('--replay',type=str,metavar="CASSETTE",default=None,
+                        help="Replay Kanboard calls and Taskwarrior commands from a cassette file instead of contacting the server/taskwarrior")
+    parser.add_argument('--replay-latency',type=float,metavar="MS",default=0.0,
+                        help="Latency (milliseconds) to inject in every replayed call")
+    parser.add_argument('--max-rpcs',type=int,metavar="N",default=None,
+                        help="Fail when more than N Kanboard calls are issued while recording/replaying (regression check)")
     parser.add_argument('-v','--verbose',action='count',default=0,help="Increase verbosity (more -v's mean an increased verbosity)")    
     if len(argv) == 1:
         print("No command line arguments provided")
@@ -59,8 +127,58 @@ def main(argv):
         loglevel=logging.WARNING
     logging.basicConfig(format='tasksync-%(levelname)s:%(message)s', level=loglevel)
 
+    if args.record or args.replay:
+        if args.record and args.replay:
+            logging.error("Recording and replaying at the same time is not supported")
+            sys.exit(1)
+        if args.replay:
+            cassette=Cassette(args.replay,"replay",latency=args.replay_latency/1000)
+        else:
+            cassette=Cassette(args.record,"record")
+        useCassette(cassette)
+        atexit.register(reportCassette,cassette,args.max_rpcs)
+
+    if args.purge and not args.project:
+        logging.error("Purging deleted project tasks requires a project name")
+        sys.exit(1)
+
+    controlpath=args.control_socket or socketPath(dbPath(args.db_path))
+    #commands which a running daemon can execute (in the order in which they are run)
+    forwardable=[command for command,requested in (("purge",args.purge),("sync",args.sync and not args.daemonize),("status",args.status),("metrics",args.metrics)) if requested]
+    localactions=args.config or args.remove or args.apply_config or args.list or args.archive is not None or args.daemonize
+    #test runs and recording/replaying need to run in this process
+    daemon=bool(forwardable) and not (args.no_daemon or args.test or args.record or args.replay or args.profiles)
+    if daemon and not localactions:
+        if forwardCommand(controlpath,forwardable[0],args.project):
+            for command in forwardable[1:]:
+                if not forwardCommand(controlpath,command,args.project):
+                    logging.error(f"Daemon on {controlpath} stopped before executing {command}")
+                    sys.exit(1)
+            sys.exit(0)
+        daemon=False
+
+    def forwarded(command):
+        """Let a running daemon execute a command of a combined invocation, returns False when it has to run in this process"""
+        return daemon and forwardCommand(controlpath,command,args.project)
+
+    if args.metrics and not (daemon and sendCommand(controlpath,{"command":"ping"}) is not None):
+        logging.error(f"No daemon is listening on {controlpath}")
+        sys.exit(1)
+
+    if args.profiles:
+        if not (args.sync and args.daemonize):
+            logging.error("Serving multiple profiles is only supported in daemon sync mode (-s -d)")
+            sys.exit(1)
+        connectors=loadProfiles(args.profiles,test=args.test,conflictpolicy=args.conflict_policy,twdirect=args.tw_direct)
+        control=ControlServer({name:socketPath(conn.dbpath) for name,conn in connectors.items()})
+        atexit.register(control.close)
+        print(f"Starting in deamon mode for {len(connectors)} profiles (checks every {args.daemonize} seconds)")
+        runDaemon(connectors,args.daemonize,args.project,archivedays=args.archive,control=control)
+
     #open up a connection with a database 
-    conn=DbConnector(test=args.test,dbpath=args.db_path)
+    #note: listing only reads from the database, so it may run alongside a running daemon
+    readonly=args.list or not (args.config or args.remove or args.apply_config or args.purge or args.sync or args.archive is not None)
+    conn=DbConnector(test=args.test,dbpath=args.db_path,readonly=readonly,conflictpolicy=args.conflict_policy,twdirect=args.tw_direct)
 
     if args.list:
         for projname,res in conn.items():
@@ -75,13 +193,12 @@ def main(argv):
             sys.exit(1)
         conn.remove(args.project)
 
-    if args.purge:
-
-        if not args.project:
-            logging.error("Purging deleted project tasks requires a project name")
-            sys.exit(1)
+    if args.purge and not forwarded("purge"):
         conn.purgeTasks(args.project)
 
+    if args.apply_config:
+        conn.applyConfig(args.apply_config)
+
     if args.config:
         if not args.project:
             logging.error("Configuring a project requires a project name")
@@ -90,24 +207,25 @@ def main(argv):
 
     if args.sync:
         if args.daemonize:
+            if args.workers:
+                print(f"Starting in deamon mode with {args.workers} workers (checks every {args.daemonize} seconds)")
+                runWorkers(args.db_path,args.workers,args.daemonize,test=args.test,archivedays=args.archive,conflictpolicy=args.conflict_policy,twdirect=args.tw_direct)
+            control=ControlServer({"default":controlpath})
+            atexit.register(control.close)
             print(f"Starting in deamon mode (checks every {args.daemonize} seconds)")
-            nfail=0
-            while True:
-                try:
-                    conn.syncTasks(args.project)
-                    #reset fail count
-                    nfail=0
-                except (TWClientError,KBClientError) as exc:
-                    nfail+=1
-                    if nfail > 10:
-                        #stop after repeated failed attempts
-                        sys.exit(1)
-
-                    #ok try again next time
-                logging.info(f"Sleeping for {args.daemonize} seconds")
-                time.sleep(args.daemonize)
-        else:
-            conn.syncTasks(args.project)
+            runDaemon({"default":conn},args.daemonize,args.project,archivedays=args.archive,control=control)
+        elif not forwarded("sync"):
+            #take the project leases, so the sync doesn't run concurrently with a worker (-w)
+            conn.syncTasks(args.project,lease=f"cli:{socket.gethostname()}-{os.getpid()}")
+
+    if args.archive is not None and not args.daemonize:
+        conn.maintenance(args.archive,force=True)
+
+    if args.status and not forwarded("status"):
+        printStatus(conn.status(args.project))
+
+    if args.metrics:
+        forwarded("metrics")
 
 
 if __name__ == "__main__":
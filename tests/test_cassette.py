@@ -0,0 +1,60 @@
+# tests of the matching of replayed calls
+
+import time
+import pytest
+from kanboard import ClientError
+from kanboard_taskwarrior.cassette import Cassette,CassetteMiss
+from kanboard_taskwarrior.clients import kbClient,useCassette
+
+@pytest.fixture
+def cassette(tmp_path):
+    path=str(tmp_path/"cassette.json.gz")
+    recorder=Cassette(path)
+    recorder.record("kb","getTask",{"task_id":1},result={"id":1})
+    recorder.record("kb","updateTask",{"id":1,"date_due":100},result=True)
+    recorder.record("kb","getTask",{"task_id":2},result={"id":2})
+    recorder.save()
+    return Cassette(path,mode="replay")
+
+def test_exact_match(cassette):
+    assert cassette.replay("kb","getTask",{"task_id":2})['result'] == {"id":2}
+    assert cassette.replay("kb","getTask",{"task_id":1})['result'] == {"id":1}
+
+def test_fallback_to_same_method(cassette):
+    assert cassette.replay("kb","updateTask",{"id":1,"date_due":200})['result'] is True
+    #the exact recording was consumed by the fallback
+    with pytest.raises(CassetteMiss):
+        cassette.replay("kb","updateTask",{"id":1,"date_due":100})
+
+def test_no_fallback_to_other_method(cassette):
+    with pytest.raises(CassetteMiss,match="Unrecorded kb call removeTask"):
+        cassette.replay("kb","removeTask",{"task_id":1})
+    #nothing was consumed
+    assert cassette.replay("kb","getTask",{"task_id":1})['result'] == {"id":1}
+
+def test_no_fallback_to_other_parameters(cassette):
+    with pytest.raises(CassetteMiss,match="Unrecorded kb call getTask"):
+        cassette.replay("kb","getTask",{"task_id":3})
+    assert cassette.replay("kb","getTask",{"task_id":1})['result'] == {"id":1}
+
+def test_fallback_on_dates_in_commands(tmp_path):
+    path=str(tmp_path/"cassette.json.gz")
+    recorder=Cassette(path)
+    recorder.record("tw","export",["project:A","modified.after:2024-01-01T10:00:00","export"],result=[])
+    recorder.save()
+    player=Cassette(path,mode="replay")
+    with pytest.raises(CassetteMiss):
+        player.replay("tw","export",["project:B","modified.after:2024-01-01T10:00:00","export"])
+    assert player.replay("tw","export",["project:A","modified.after:2025-06-01T12:30:00","export"])['result'] == []
+
+def test_replay_is_not_rate_limited(cassette):
+    useCassette(cassette)
+    try:
+        clnt=kbClient("http://kanboard.example.com","me","token")
+        t0=time.monotonic()
+        for i in range(20):
+            with pytest.raises(ClientError):
+                clnt.removeTask(task_id=i)
+        assert time.monotonic()-t0 < 1
+    finally:
+        useCassette(None)
@@ -0,0 +1,54 @@
+# tests of the declarative configuration of project links
+
+import pytest
+import kanboard_taskwarrior.config as config
+from kanboard_taskwarrior.config import declarativeConfig
+from kanboard_taskwarrior.taskmap import colkey,swimkey,catkey
+
+class UserClient:
+    """Kanboard client with the permissions of an ordinary user (no admin-only calls)"""
+    def __init__(self):
+        self.calls=[]
+
+    def __getattr__(self,name):
+        raise AssertionError(f"{name} is not available to ordinary users")
+
+    def getProjectByName(self,name):
+        self.calls.append("getProjectByName")
+        return {"id":"7","name":name} if name == "ProjA" else None
+
+    def getUserByName(self,username):
+        self.calls.append("getUserByName")
+        return {"id":"3","username":username} if username == "me" else None
+
+    def getAllCategories(self,project_id):
+        return [{"id":"1","name":"Bug"}]
+
+    def getActiveSwimlanes(self,project_id):
+        return [{"id":"1","name":"Default swimlane"}]
+
+    def getColumns(self,project_id):
+        return [{"id":"1","title":"Backlog"},{"id":"2","title":"Work in progress"},{"id":"3","title":"Done"}]
+
+@pytest.fixture
+def client(monkeypatch):
+    clnt=UserClient()
+    monkeypatch.setattr(config,"kbClient",lambda url,user,apitoken: clnt)
+    return clnt
+
+server={"url":"kanboard.example.com","user":"me","apitoken":"token"}
+
+def test_lookup_by_name(client):
+    configs,problems=declarativeConfig({"servers":{"work":server},
+        "projects":{"ProjA":{"server":"work","assignee":"me","categories":{"bug":"Bug"}}}})
+    assert problems == []
+    assert configs[0]["projid"] == "7"
+    assert configs[0]["assignee"] == {"user":"me","kbid":"3"}
+    assert configs[0]["mapping"][catkey] == {"bug":{"kbid":"1","name":"Bug"}}
+    assert set(configs[0]["mapping"][colkey]) and set(configs[0]["mapping"][swimkey])
+
+def test_unknown_project_and_user(client):
+    configs,problems=declarativeConfig({"servers":{"work":server},
+        "projects":{"ProjB":{"server":"work"},"ProjA":{"server":"work","assignee":"you"}}})
+    assert configs == []
+    assert len(problems) == 2
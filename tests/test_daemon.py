@@ -0,0 +1,64 @@
+# tests of the commands executed by a running daemon
+
+import socket
+import sqlite3
+import pytest
+from datetime import datetime
+from kanboard_taskwarrior.db import DbConnector,kbserverTable
+from kanboard_taskwarrior.daemon import handleCommand,runDaemon
+from kanboard_taskwarrior.control import sendCommand
+
+@pytest.fixture
+def conn(tmp_path):
+    return DbConnector(dbpath=str(tmp_path/"sync.sql"))
+
+def register(conn,project):
+    with conn._dbcon:
+        conn._dbcon.execute(f"INSERT INTO {kbserverTable} (url,user,apitoken,project,projid,assignee,mapping,lastsync) VALUES ('http://localhost','me','token',?,1,'','{{}}',?)",(project,datetime(2000,1,1)))
+
+def test_failing_command(conn,monkeypatch):
+    def syncTasks(project=None):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(conn,"syncTasks",syncTasks)
+    reply=handleCommand(conn,{"command":"sync"},{})
+    assert not reply["ok"]
+    assert "database is locked" in reply["error"]
+
+def test_unknown_command(conn):
+    reply=handleCommand(conn,{"command":"explode"},{})
+    assert not reply["ok"]
+
+def test_reload_entries(conn):
+    register(conn,"ProjA")
+    assert list(handleCommand(conn,{"command":"status"},{})["result"]) == ["ProjA"]
+    #registered by another process while the daemon is running
+    register(conn,"ProjB")
+    assert sorted(handleCommand(conn,{"command":"status"},{})["result"]) == ["ProjA","ProjB"]
+
+class StopDaemon(Exception):
+    pass
+
+class OneCycle:
+    """Control server stand-in which stops the daemon after the first cycle"""
+    def serve(self,timeout,handler):
+        raise StopDaemon()
+
+def test_failing_profile_is_isolated(tmp_path,monkeypatch):
+    connectors={name:DbConnector(dbpath=str(tmp_path/f"{name}.sql")) for name in ("broken","healthy")}
+    synced=[]
+    def fail(project=None):
+        raise RuntimeError("Did not succeed to update kanboard task")
+    monkeypatch.setattr(connectors["broken"],"syncTasks",fail)
+    monkeypatch.setattr(connectors["healthy"],"syncTasks",lambda project=None: synced.append("healthy"))
+    with pytest.raises(StopDaemon):
+        runDaemon(connectors,1,control=OneCycle())
+    assert synced == ["healthy"]
+
+def test_socket_of_other_user(tmp_path,monkeypatch):
+    path=str(tmp_path/"sync.sock")
+    open(path,"w").close()
+    def connect(self,address):
+        raise PermissionError(13,"Permission denied")
+    monkeypatch.setattr(socket.socket,"connect",connect)
+    #the command then runs in the calling process
+    assert sendCommand(path,{"command":"status"}) is None
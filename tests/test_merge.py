@@ -0,0 +1,86 @@
+# unit tests of the three-way merge of taskwarrior and kanboard states
+
+from datetime import datetime
+import pytest
+from kanboard_taskwarrior.taskmap import mergeStates,twNeedsUpdate,conflictTag
+from kanboard_taskwarrior.snapshot import TWSnapshot
+
+base={"title":"A","due":0,"vtag":"BACKLOG","swimlane":None,"category":None}
+older=datetime(2024,1,1,12,0,0)
+newer=datetime(2024,1,1,13,0,0)
+
+def state(**fields):
+    return dict(base,**fields)
+
+def test_unchanged():
+    twtarget,kbtarget,newbase,flagged=mergeStates(base,state(),state())
+    assert twtarget == kbtarget == newbase == base
+    assert flagged == []
+
+def test_taskwarrior_side_only():
+    twtarget,kbtarget,newbase,flagged=mergeStates(base,state(title="B"),state(),policy="kanboard")
+    assert twtarget["title"] == kbtarget["title"] == newbase["title"] == "B"
+    assert flagged == []
+
+def test_kanboard_side_only():
+    twtarget,kbtarget,newbase,flagged=mergeStates(base,state(),state(due=1700000000),policy="taskwarrior")
+    assert twtarget["due"] == kbtarget["due"] == newbase["due"] == 1700000000
+    assert flagged == []
+
+def test_different_fields_on_both_sides():
+    twtarget,kbtarget,newbase,flagged=mergeStates(base,state(title="B"),state(vtag="ACTIVE"),policy="flag")
+    assert twtarget == kbtarget == newbase == state(title="B",vtag="ACTIVE")
+    assert flagged == []
+
+@pytest.mark.parametrize("policy,twmod,kbmod,expected",[
+    ("newest",older,newer,"KB"),
+    ("newest",newer,older,"TW"),
+    ("newest",None,None,"KB"),
+    ("kanboard",newer,older,"KB"),
+    ("taskwarrior",older,newer,"TW"),
+])
+def test_both_sides_changed(policy,twmod,kbmod,expected):
+    twtarget,kbtarget,newbase,flagged=mergeStates(base,state(title="TW"),state(title="KB"),policy,twmod,kbmod)
+    assert twtarget["title"] == kbtarget["title"] == newbase["title"] == expected
+    assert flagged == []
+
+def test_both_sides_changed_flag():
+    twtarget,kbtarget,newbase,flagged=mergeStates(base,state(title="TW"),state(title="KB",vtag="ACTIVE"),"flag")
+    #both sides keep their value and the field has no common base anymore
+    assert twtarget["title"] == "TW"
+    assert kbtarget["title"] == "KB"
+    assert newbase["title"] is None
+    assert flagged == ["title"]
+    #fields changed on one side are still merged
+    assert twtarget["vtag"] == kbtarget["vtag"] == newbase["vtag"] == "ACTIVE"
+
+def test_flagged_field_stays_flagged():
+    #the base of a flagged field is None, so it conflicts until both sides agree
+    flaggedbase=dict(base,title=None)
+    *_,flagged=mergeStates(flaggedbase,state(title="TW"),state(title="KB"),"flag")
+    assert flagged == ["title"]
+    *_,flagged=mergeStates(flaggedbase,state(title="KB"),state(title="KB"),"flag")
+    assert flagged == []
+
+@pytest.mark.parametrize("policy,expected",[("newest","KB"),("kanboard","KB"),("taskwarrior","A")])
+def test_null_base(policy,expected):
+    #without a base every difference is a conflict, even if one side equals the old value
+    twtarget,kbtarget,newbase,flagged=mergeStates(None,state(),state(title="KB"),policy,older,newer)
+    assert twtarget["title"] == kbtarget["title"] == newbase["title"] == expected
+    assert twtarget["vtag"] == "BACKLOG"
+
+def test_null_base_flag():
+    twtarget,kbtarget,newbase,flagged=mergeStates(None,state(title="TW"),state(title="KB"),"flag")
+    assert flagged == ["title"]
+    assert newbase["title"] is None
+    assert newbase["due"] == 0
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        mergeStates(base,state(),state(),"random")
+
+def test_conflict_tag_needs_update():
+    twtask=TWSnapshot("uuid","A")
+    assert not twNeedsUpdate(base,twtask)
+    twtask.tags=(conflictTag,)
+    assert twNeedsUpdate(base,twtask)
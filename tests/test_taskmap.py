@@ -0,0 +1,97 @@
+# tests of the calls which are sent to update kanboard and taskwarrior tasks
+
+from datetime import datetime
+import pytest
+from kanboard_taskwarrior.taskmap import kbFromState,twFromState,twNeedsUpdate,stateFromkb,stateFromtw,colkey,swimkey,catkey
+from kanboard_taskwarrior.snapshot import KBSnapshot,TWSnapshot
+
+projconf={"projid":3,"assignee":"",
+        "mapping":{colkey:{"WAITING":{"kbid":"1"},"ACTIVE":{"kbid":"2"},"COMPLETED":{"kbid":"3"}},
+                   swimkey:{"default":{"kbid":"1"},"other":{"kbid":"2"}},
+                   catkey:{"bug":{"kbid":"5"}}}}
+
+class RecordingClient:
+    """Kanboard client stand-in which records the calls and lets them succeed"""
+    def __init__(self):
+        self.calls=[]
+
+    def __getattr__(self,name):
+        def function(**kwargs):
+            self.calls.append((name,kwargs))
+            return True
+        return function
+
+    def names(self):
+        return [name for name,kwargs in self.calls]
+
+class NoClient:
+    """Taskwarrior client stand-in which must not be used"""
+    def __getattr__(self,name):
+        raise AssertionError(f"Unexpected taskwarrior call {name}")
+
+def snapshot(**fields):
+    values=dict(title="A",due=0,column=1,swimlane=1,category=5,active=True,modified=100,position=4)
+    values.update(fields)
+    return KBSnapshot(1,**values)
+
+@pytest.fixture
+def client():
+    return RecordingClient()
+
+def test_unchanged_task(client):
+    kbtask=snapshot()
+    kbid,kbtask=kbFromState(stateFromkb(kbtask,projconf),client,projconf,kbtask=kbtask)
+    assert client.calls == []
+    assert kbtask.modified == 100
+
+def test_title_only(client):
+    kbtask=snapshot()
+    kbFromState(dict(stateFromkb(kbtask,projconf),title="B"),client,projconf,kbtask=kbtask)
+    assert client.calls == [("updateTask",{"title":"B","id":1})]
+
+def test_swimlane_move_keeps_position(client):
+    kbtask=snapshot()
+    kbid,kbtask=kbFromState(dict(stateFromkb(kbtask,projconf),swimlane="other"),client,projconf,kbtask=kbtask)
+    assert client.names() == ["moveTaskPosition"]
+    assert client.calls[0][1]["position"] == 4
+    assert client.calls[0][1]["swimlane_id"] == 2
+    assert kbtask.swimlane == 2 and kbtask.position == 4
+
+def test_column_move_to_top(client):
+    kbtask=snapshot()
+    kbid,kbtask=kbFromState(dict(stateFromkb(kbtask,projconf),vtag="ACTIVE"),client,projconf,kbtask=kbtask)
+    assert client.names() == ["moveTaskPosition"]
+    assert client.calls[0][1]["position"] == 1
+    assert kbtask.column == 2
+
+def test_close_only_when_open(client):
+    closed=snapshot(column=3,active=False)
+    kbFromState(stateFromkb(closed,projconf),client,projconf,kbtask=closed)
+    assert client.calls == []
+    opened=snapshot(column=3)
+    kbid,kbtask=kbFromState(stateFromkb(opened,projconf),client,projconf,kbtask=opened)
+    assert client.names() == ["closeTask"]
+    assert not kbtask.active
+
+def test_open_only_when_closed(client):
+    active=snapshot(column=2)
+    kbFromState(stateFromkb(active,projconf),client,projconf,kbtask=active)
+    assert client.calls == []
+    closed=snapshot(column=2,active=False)
+    kbid,kbtask=kbFromState(stateFromkb(closed,projconf),client,projconf,kbtask=closed)
+    assert client.names() == ["openTask"]
+    assert kbtask.active
+
+def test_unchanged_taskwarrior_task():
+    twtask=TWSnapshot("uuid","A",swimlane="default",category="bug",modified=datetime(2024,1,1))
+    state=stateFromtw(twtask,projconf)
+    assert not twNeedsUpdate(state,twtask)
+    #no taskwarrior command is executed
+    assert twFromState(state,NoClient(),projconf,twtask=twtask) == ("uuid",twtask)
+
+def test_taskwarrior_task_needs_update():
+    twtask=TWSnapshot("uuid","A",swimlane="default",modified=datetime(2024,1,1))
+    state=stateFromtw(twtask,projconf)
+    assert twNeedsUpdate(dict(state,title="B"),twtask)
+    assert twNeedsUpdate(dict(state,swimlane="other"),twtask)
+    assert twNeedsUpdate(dict(state,due=1700000000),twtask)
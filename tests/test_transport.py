@@ -0,0 +1,124 @@
+# unit tests of the transport policy (token bucket, AIMD rate and circuit breaker) on a fake clock
+
+import pytest
+import requests
+from kanboard import ClientError
+import kanboard_taskwarrior.transport as transport
+from kanboard_taskwarrior.transport import TransportPolicy,CircuitOpen,isTransportError
+from kanboard_taskwarrior.clients import serverIsreachable
+
+class FakeTime:
+    def __init__(self):
+        self.now=1000.0
+        self.slept=0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self,seconds):
+        self.now+=seconds
+        self.slept+=seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake=FakeTime()
+    monkeypatch.setattr(transport,"time",fake)
+    return fake
+
+def transportError(msg="connection refused"):
+    #the kanboard client chains the cause of network failures
+    try:
+        raise ClientError(msg) from ConnectionError(msg)
+    except ClientError as exc:
+        return exc
+
+def failing(exc):
+    def func():
+        raise exc
+    return func
+
+def test_token_bucket(clock):
+    #rates which are exact in binary keep the fake clock exact
+    policy=TransportPolicy(rate=4.0,maxrate=4.0,burst=2,slowcall=100)
+    for i in range(2):
+        policy.execute("getTask",lambda: True)
+    #the burst is used up, so the next calls wait for new tokens
+    assert clock.slept == 0
+    for i in range(3):
+        policy.execute("getTask",lambda: True)
+    assert clock.slept == pytest.approx(0.75)
+
+def test_aimd(clock):
+    policy=TransportPolicy(rate=5.0,minrate=1.0,maxrate=6.0,slowcall=2.0)
+    policy.success(0.1)
+    assert policy.rate == 5.5
+    policy.success(0.1)
+    policy.success(0.1)
+    assert policy.rate == 6.0
+    policy.success(3.0)
+    assert policy.rate == pytest.approx(4.8)
+    policy.failure()
+    assert policy.rate == pytest.approx(2.4)
+    policy.failure()
+    policy.failure()
+    assert policy.rate == 1.0
+
+def test_api_errors_do_not_trip_the_breaker(clock):
+    policy=TransportPolicy(failthreshold=2)
+    for i in range(5):
+        with pytest.raises(ClientError):
+            policy.execute("updateTask",failing(ClientError("invalid task")))
+    assert policy.state == "closed"
+    assert policy.nerrors == 0
+
+def test_retries_of_reads_only(clock):
+    policy=TransportPolicy(retries=2,failthreshold=10)
+    with pytest.raises(ClientError):
+        policy.execute("getTask",failing(transportError()))
+    assert policy.ncalls == 3 and policy.nretries == 2
+    with pytest.raises(ClientError):
+        policy.execute("createTask",failing(transportError()))
+    assert policy.ncalls == 4
+
+def test_circuit_breaker(clock):
+    policy=TransportPolicy(retries=0,failthreshold=3,cooldown=60)
+    for i in range(3):
+        with pytest.raises(ClientError):
+            policy.execute("getTask",failing(transportError()))
+    assert policy.state == "open"
+    calls=[]
+    with pytest.raises(CircuitOpen):
+        policy.execute("getTask",lambda: calls.append(1))
+    assert not calls
+    #after the cooldown a failing probe opens the circuit again
+    clock.now+=61
+    assert policy.state == "half-open"
+    with pytest.raises(ClientError):
+        policy.execute("getTask",failing(transportError()))
+    assert policy.state == "open"
+    #and a successful probe closes it
+    clock.now+=61
+    assert policy.execute("getTask",lambda: "ok") == "ok"
+    assert policy.state == "closed"
+
+def test_unexpected_probe_error_releases_half_open_circuit(clock):
+    policy=TransportPolicy(retries=0,failthreshold=1,cooldown=60)
+    with pytest.raises(ClientError):
+        policy.execute("getTask",failing(transportError()))
+    clock.now+=61
+    with pytest.raises(requests.ReadTimeout):
+        policy.execute("probe",failing(requests.ReadTimeout()))
+    assert policy.available()
+
+def test_circuit_open_is_a_transport_error():
+    assert isTransportError(CircuitOpen("Circuit open"))
+    assert isTransportError(transportError())
+    assert not isTransportError(ClientError("invalid task"))
+
+def test_probe_timeout(clock,monkeypatch):
+    def head(server,timeout):
+        raise requests.ReadTimeout("read timed out")
+    monkeypatch.setattr(requests,"head",head)
+    policy=TransportPolicy(retries=0,failthreshold=1)
+    assert not serverIsreachable("http://kanboard.example.com",policy=policy)
+    assert policy.state == "open"
@@ -0,0 +1,113 @@
+# multi-process test of the lease coordination of the sync workers
+
+import os
+import time
+import signal
+import socket
+import multiprocessing
+from datetime import datetime
+import pytest
+from kanboard_taskwarrior.db import DbConnector,leaseTable,kbserverTable,maintenanceLease
+from kanboard_taskwarrior.workers import workerLoop
+
+ttl=2
+#the fixture replaces the synchronization, some tests need the real one
+realSyncTasks=DbConnector.syncTasks
+nworkers=3
+projects=[f"project{i}" for i in range(6)]
+
+def leases(conn):
+    if not conn.tableExists(leaseTable):
+        return {}
+    with conn.newcur() as cur:
+        return {row['project']:row['owner'] for row in cur.execute(f"SELECT project,owner FROM {leaseTable} WHERE expires > ? AND project IN ({','.join('?'*len(projects))})",(time.time(),*projects))}
+
+def waitFor(condition,timeout):
+    t0=time.monotonic()
+    while time.monotonic()-t0 < timeout:
+        result=condition()
+        if result:
+            return time.monotonic()-t0
+        time.sleep(0.1)
+    raise AssertionError(f"condition not met within {timeout} seconds")
+
+@pytest.fixture
+def dbpath(tmp_path,monkeypatch):
+    path=str(tmp_path/"sync.sql")
+    conn=DbConnector(dbpath=path)
+    with conn._dbcon:
+        conn._dbcon.executemany(f"INSERT INTO {kbserverTable} (url,user,apitoken,project,projid,assignee,mapping,lastsync) VALUES ('http://localhost','user','token',?,?,'','{{}}',?)",
+                [(project,i,datetime(2000,1,1)) for i,project in enumerate(projects)])
+    #the lease coordination is tested, not the synchronization itself (the forked workers inherit the patch)
+    monkeypatch.setattr(DbConnector,"syncTasks",lambda self,project=None: None)
+    return path
+
+def test_takeover_of_crashed_worker(dbpath):
+    ctx=multiprocessing.get_context("fork")
+    procs=[ctx.Process(target=workerLoop,args=(dbpath,3600,ttl),daemon=True) for i in range(nworkers)]
+    for proc in procs:
+        proc.start()
+    try:
+        conn=DbConnector(dbpath=dbpath,readonly=True)
+        #all projects get leased, spread over the workers
+        waitFor(lambda: len(leases(conn)) == len(projects) and len(set(leases(conn).values())) == nworkers,10)
+
+        victim=procs[0]
+        dead=f"{socket.gethostname()}-{victim.pid}"
+        os.kill(victim.pid,signal.SIGKILL)
+        victim.join()
+        orphans=[project for project,owner in leases(conn).items() if owner == dead]
+        assert orphans
+
+        def takenOver():
+            current=leases(conn)
+            return all(current.get(project) not in (None,dead) for project in orphans)
+        #leases expire within the ttl, after which the heartbeat (every ttl/3) of the other workers claims them
+        elapsed=waitFor(takenOver,ttl*2)
+        assert elapsed <= ttl*4/3+1
+        #and the remaining workers keep them
+        time.sleep(ttl)
+        assert takenOver() and len(leases(conn)) == len(projects)
+    finally:
+        for proc in procs[1:]:
+            proc.terminate()
+            proc.join()
+
+def test_single_maintenance_lease(dbpath):
+    conn=DbConnector(dbpath=dbpath)
+    assert conn.claimMaintenance("worker1",ttl)
+    assert not conn.claimMaintenance("worker2",ttl)
+    conn.releaseLease("worker1",maintenanceLease)
+    assert conn.claimMaintenance("worker2",ttl)
+    #the maintenance lease is not handed out as a project
+    assert maintenanceLease not in conn.claimProjects("worker2",ttl)
+
+def test_no_release_while_syncing(dbpath):
+    first=DbConnector(dbpath=dbpath)
+    second=DbConnector(dbpath=dbpath)
+    assert first.claimProjects("first",ttl*10) == projects
+    #a second worker joins while the first one is syncing: the heartbeat of the first must not release projects
+    assert second.claimProjects("second",ttl*10) == []
+    assert first.claimProjects("first",ttl*10,release=False) == projects
+    assert second.claimProjects("second",ttl*10) == []
+    assert first.liveWorkers() == 2
+    #in between syncs the surplus is released and taken over
+    kept=first.claimProjects("first",ttl*10)
+    taken=second.claimProjects("second",ttl*10)
+    assert len(kept) == len(taken) == len(projects)//2
+    assert not set(kept)&set(taken)
+
+def test_command_line_sync_respects_worker_leases(dbpath,monkeypatch):
+    synced=[]
+    monkeypatch.setattr(DbConnector,"syncTasks",realSyncTasks)
+    monkeypatch.setattr(DbConnector,"syncSingle",lambda self,entry: synced.append(entry['project']))
+    worker=DbConnector(dbpath=dbpath)
+    held=worker.claimProjects("worker",ttl*10)
+    cli=DbConnector(dbpath=dbpath)
+    cli.syncTasks(lease="cli")
+    assert held == projects and synced == []
+    worker.releaseLeases("worker")
+    cli.syncTasks(projects[0],lease="cli")
+    assert synced == [projects[0]]
+    #the lease is released after the sync
+    assert worker.acquireLease("worker",projects[0],ttl)